@@ -0,0 +1,73 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from logger import logger
+
+# Most events of a batch handled at once, each one also runs its commands concurrently
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '10'))
+
+SQS = 'aws:sqs'
+SNS = 'aws:sns'
+
+
+class BatchFailure(Exception):
+    '''
+    Raised for an SNS batch with failed records, SNS has no partial
+    batch response so the whole invocation has to fail to be retried
+    '''
+    def __init__(self, failures):
+        super(BatchFailure, self).__init__("Failed records: {}".format(failures))
+        self.failures = failures
+
+
+def is_batch(event):
+    return 'Records' in event and 'RequestType' not in event
+
+
+def record_id(record):
+    '''
+    Returns the id SQS expects back in batchItemFailures, or the SNS message id
+    '''
+    if 'messageId' in record:
+        return record['messageId']
+    return record.get('Sns', {}).get('MessageId')
+
+
+def unwrap(record):
+    '''
+    Returns the CloudFormation event carried by an SQS or SNS record.
+    An SQS body can itself be an SNS notification, when the queue is
+    subscribed to the topic without raw message delivery.
+    '''
+    if record.get('EventSource', record.get('eventSource')) == SNS:
+        return json.loads(record['Sns']['Message'])
+    body = json.loads(record['body'])
+    if body.get('Type') == 'Notification' and 'Message' in body:
+        return json.loads(body['Message'])
+    return body
+
+
+def run_batch(event, context, handle, max_workers=None):
+    '''
+    Runs handle(cfn_event, context) for every record in a Records[] batch
+    on a bounded thread pool. handle returns False, or raises, when the
+    event's response was not delivered. Each failed record is isolated
+    from the rest and reported in batchItemFailures so SQS only
+    redelivers those.
+    '''
+    records = event['Records']
+
+    def run(record):
+        try:
+            return handle(unwrap(record), context)
+        except Exception as e:
+            logger.exception("Batch: Record %s failed: %s", record_id(record), e)
+            return False
+
+    with ThreadPoolExecutor(max_workers=max_workers or BATCH_CONCURRENCY) as executor:
+        results = list(executor.map(run, records))
+    failures = [record_id(record) for record, ok in zip(records, results) if not ok]
+    logger.info("Batch: %s records, %s failed", len(records), len(failures))
+    if failures and any(record.get('EventSource') == SNS for record in records):
+        raise BatchFailure(failures)
+    return {'batchItemFailures': [{'itemIdentifier': failure} for failure in failures]}
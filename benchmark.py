@@ -0,0 +1,578 @@
+#!/usr/bin/env python3.6
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import timeit
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+from datetime import date, datetime
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import cfnresponse
+from helper import compile_modifiers, compile_template, lookup, traverse, traverse_find, traverse_modify, remove_prefix, inject_rand, serializable, to_path
+from logger import logger
+
+
+def synthetic_event(commands=20, width=20):
+    '''
+    Builds a CloudFormation style event with many commands, each looking up
+    values from the event and from the response of the command before it
+    '''
+    return {
+        'RequestType': 'Create',
+        'PhysicalResourceId': 'pid-1234',
+        'ResourceProperties': {
+            'Name': 'bench',
+            'Create': {
+                'PhysicalResourceId': '!Create[0].Resource.Id',
+                'ResponseData': {
+                    'Last': '!Create[{}].!str.Resource.Count'.format(commands - 1)
+                },
+                'Commands': [
+                    {
+                        'Client': 'ec2',
+                        'Method': 'describe_things',
+                        'Arguments': dict(
+                            [('Name', '!event.ResourceProperties.Name'),
+                             ('Token', 'bench-!random'),
+                             ('Count', '!int.{}'.format(i)),
+                             ('Previous', '!Create[{}].Resource.Id'.format(i - 1) if i else '!event.PhysicalResourceId')] +
+                            [('Static{}'.format(n), 'value') for n in range(width)]
+                        )
+                    } for i in range(commands)
+                ]
+            }
+        }
+    }
+
+def synthetic_response(i, width=20):
+    return {
+        'Resource': dict(
+            [('Id', 'id-{}'.format(i)), ('Count', i)] +
+            [('Field{}'.format(n), 'value') for n in range(width)]
+        )
+    }
+
+
+def describe_instances_response(reservations=1000, instances=2):
+    '''
+    Builds a response shaped like ec2.describe_instances, about 2KB an instance
+    '''
+    return {
+        'Reservations': [
+            {
+                'ReservationId': 'r-{:08x}'.format(r),
+                'OwnerId': '123456789012',
+                'Groups': [],
+                'Instances': [
+                    {
+                        'InstanceId': 'i-{:08x}{:04x}'.format(r, i),
+                        'ImageId': 'ami-cb17d8b6',
+                        'InstanceType': 't2.large',
+                        'PrivateIpAddress': '10.0.{}.{}'.format(r % 256, i),
+                        'State': {'Code': 16, 'Name': 'running'},
+                        'BlockDeviceMappings': [
+                            {'DeviceName': '/dev/xvda', 'Ebs': {'VolumeId': 'vol-{:08x}{:04x}'.format(r, i), 'Status': 'attached', 'DeleteOnTermination': True}}
+                        ],
+                        'NetworkInterfaces': [
+                            {'NetworkInterfaceId': 'eni-{:08x}{:04x}'.format(r, i), 'SubnetId': 'subnet-0000', 'VpcId': 'vpc-0000',
+                             'PrivateIpAddresses': [{'Primary': True, 'PrivateIpAddress': '10.0.{}.{}'.format(r % 256, i)}]}
+                        ],
+                        'SecurityGroups': [{'GroupId': 'sg-0000', 'GroupName': 'default'}],
+                        'Tags': [{'Key': 'Tag{}'.format(t), 'Value': 'x' * 40} for t in range(10)]
+                    } for i in range(instances)
+                ]
+            } for r in range(reservations)
+        ]
+    }
+
+
+def dynamodb_items_response(items=2000, width=20):
+    '''
+    Builds a response shaped like a DynamoDB query through the boto3 resource
+    layer, every number a Decimal and string sets as sets
+    '''
+    return {
+        'Items': [
+            dict(
+                [('Id', 'item-{}'.format(i)), ('Version', Decimal(i)), ('Price', Decimal('{}.99'.format(i))),
+                 ('Tags', set('tag-{}'.format(t) for t in range(5))), ('Location', {'Lat': Decimal('52.37'), 'Lon': Decimal('4.89')})] +
+                [('Metric{}'.format(n), Decimal(n * i)) for n in range(width)]
+            ) for i in range(items)
+        ],
+        'Count': Decimal(items),
+        'ScannedCount': Decimal(items)
+    }
+
+
+####
+# The recursive, copying traversal as it was before helper.traverse was made
+# iterative and copy on write, kept here as the baseline to compare against
+######
+def legacy_traverse(obj, path=None, callback=None):
+    if path is None:
+        path = []
+    if isinstance(obj, dict):
+        value = {k: legacy_traverse(v, path + [k], callback) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        value = [legacy_traverse(elem, path + [[]], callback) for elem in obj]
+    else:
+        value = obj
+    if callback is None:
+        return value
+    return callback(path, value)
+
+def legacy_traverse_modify(obj, target_path, action):
+    target_path = to_path(target_path)
+    def transformer(path, value):
+        if path == target_path:
+            return action(value)
+        return value
+    return legacy_traverse(obj, callback=transformer)
+
+def legacy_traverse_find(obj, trigger, action):
+    def finder(path, value):
+        if isinstance(value, str) and value.startswith(trigger):
+            return action(value)
+        return value
+    return legacy_traverse(obj, callback=finder)
+
+def legacy_lookup(obj, path):
+    buff = []
+    legacy_traverse_modify(obj, path, buff.append)
+    return buff[-1] if buff else None
+
+
+def return_modifier(text):
+    '''
+    Modifier parsing and conversion as they were before compile_modifiers,
+    kept here as the baseline to compare against
+    '''
+    for mod in ['str', 'int']:
+        mod_syntax = "!{}.".format(mod)
+        if mod_syntax in text:
+            return (mod, text.replace(mod_syntax, ''))
+    return (None, text)
+
+def convert(value, type_):
+    import importlib
+    try:
+        module = importlib.import_module('builtins')
+        cls = getattr(module, type_)
+    except AttributeError:
+        module, type_ = type_.rsplit(".", 1)
+        module = importlib.import_module(module)
+        cls = getattr(module, type_)
+    return cls(value)
+
+
+def legacy_template(event, commands_count, width):
+    '''
+    The templating chain as it was before compile_template, kept here
+    as the baseline to compare against
+    '''
+    def fetch(obj, path):
+        return legacy_lookup(obj, path)
+    def mod(value):
+        m, value = return_modifier(value)
+        return convert(value, m) if m else value
+
+    data = legacy_traverse_find(event, '!random', lambda v: inject_rand(v, '!random'))
+    data = legacy_traverse_find(data, '!event.', lambda v: fetch(event, remove_prefix(v, '!event.')))
+    for modifier in ['!str.', '!int.']:
+        data = legacy_traverse_find(data, modifier, mod)
+    commands = data['ResourceProperties']['Create']['Commands']
+    response_data = data['ResourceProperties']['Create']['ResponseData']
+    for count in range(commands_count):
+        place_holder = 'Create[{}]'.format(count)
+        response_data[place_holder] = synthetic_response(count, width)
+        def variable_fetch(value):
+            m, value = return_modifier(remove_prefix(value, '!{}.'.format(place_holder)))
+            found = fetch(response_data[place_holder], value)
+            return convert(found, m) if m else found
+        commands = legacy_traverse_find(commands, '!{}'.format(place_holder), variable_fetch)
+        response_data = legacy_traverse_find(response_data, '!{}'.format(place_holder), variable_fetch)
+    return response_data
+
+def compiled_template(event, commands_count, width):
+    plan = compile_template(event)
+    response_data = plan.data['ResourceProperties']['Create']['ResponseData']
+    for count in range(commands_count):
+        place_holder = 'Create[{}]'.format(count)
+        response_data[place_holder] = synthetic_response(count, width)
+        plan.resolve(place_holder, response_data[place_holder])
+    return response_data
+
+
+def bench_template(args):
+    event = synthetic_event(args.commands, args.width)
+    results = {}
+    for name, func in [('legacy', legacy_template), ('compiled', compiled_template)]:
+        timer = timeit.Timer(lambda: func(event, args.commands, args.width))
+        results[name] = min(timer.repeat(repeat=args.repeat, number=1))
+    results['speedup'] = results['legacy'] / results['compiled']
+    return results
+
+
+def bench_modifiers(args):
+    '''
+    Per value cost of applying a modifier, looked up on every value as
+    convert did, and compiled once into a bound callable
+    '''
+    values = [str(i) for i in range(args.values)]
+    modifier, rest = compile_modifiers('!int.Count')
+    chain, rest = compile_modifiers('!json.!len.Count')
+    documents = ['[{}]'.format(','.join(['1'] * (i % 10))) for i in range(args.values)]
+    cases = [
+        ('convert', lambda: [convert(value, 'int') for value in values]),
+        ('compiled', lambda: [modifier(value) for value in values]),
+        ('compiled_chain', lambda: [chain(document) for document in documents]),
+    ]
+    results = {'values': args.values}
+    for name, func in cases:
+        seconds = min(timeit.Timer(func).repeat(repeat=args.repeat, number=1))
+        results[name] = {'seconds': seconds, 'ns_per_value': seconds / args.values * 1e9}
+    results['speedup'] = results['convert']['seconds'] / results['compiled']['seconds']
+    return results
+
+
+def measure(func, repeat):
+    '''
+    Returns the best time of repeat runs of func, and the peak memory allocated by one run
+    '''
+    best = min(timeit.Timer(func).repeat(repeat=repeat, number=1))
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': best, 'peak_bytes': peak}
+
+def isinstance_chain(value):
+    '''
+    Converts a value with a chain of isinstance checks, the way json_serial
+    did, kept here as the baseline for the handler table in normalize
+    '''
+    if isinstance(value, (dict, list, str, int, float, bool, type(None))):
+        return value
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode('utf-8')
+    if isinstance(value, (set, frozenset)):
+        return sorted(isinstance_chain(item) for item in value)
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError("Type %s not serializable" % type(value))
+
+def bench_normalize(args):
+    response = dynamodb_items_response(args.reservations, args.width)
+    values = [0]
+    def count(path, value):
+        values[0] += 1
+        return value
+    traverse(response, callback=count)
+    results = {'values': values[0]}
+    cases = [
+        ('isinstance_chain', lambda: traverse(response, callback=lambda path, value: isinstance_chain(value))),
+        ('dispatch', lambda: serializable(response)),
+    ]
+    for name, func in cases:
+        results[name] = measure(func, args.repeat)
+        results[name]['ns_per_value'] = results[name]['seconds'] / values[0] * 1e9
+    results['speedup'] = results['isinstance_chain']['seconds'] / results['dispatch']['seconds']
+    return results
+
+def bench_traverse(args):
+    response = describe_instances_response(args.reservations)
+    path = 'Reservations[].Instances[].InstanceId'
+    results = {'response_bytes': len(json.dumps(response))}
+    cases = [
+        ('lookup', lambda: legacy_lookup(response, path), lambda: lookup(response, path)),
+        ('traverse_modify', lambda: legacy_traverse_modify(response, 'Reservations', len),
+                            lambda: traverse_modify(response, 'Reservations', len)),
+        ('traverse_find', lambda: legacy_traverse_find(response, '!', str),
+                          lambda: traverse_find(response, '!', str)),
+    ]
+    for name, legacy, current in cases:
+        results[name] = {
+            'legacy': measure(legacy, args.repeat),
+            'current': measure(current, args.repeat)
+        }
+    return results
+
+
+####
+# Handler harness
+# Drives lambda_handler end to end, with stand-in clients in place of AWS and
+# a local HTTP server capturing the responses sent to CloudFormation.
+######
+class StandInClient(object):
+    '''
+    Stands in for a boto3 client, every method returns responses(method, arguments)
+    '''
+    def __init__(self, service, responses, calls):
+        self.service = service
+        self.responses = responses
+        self.calls = calls
+
+    def can_paginate(self, method):
+        return False
+
+    def __getattr__(self, method):
+        def call(**arguments):
+            self.calls.append((self.service, method))
+            return self.responses(method, arguments)
+        return call
+
+class StandInSession(object):
+    region_name = 'us-east-1'
+    profile_name = None
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def get_credentials(self):
+        return None
+
+    def client(self, service, **kwargs):
+        return StandInClient(service, self.responses, self.calls)
+
+class CaptureHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like S3, so the connection pool in cfnresponse is exercised
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.captured.append(json.loads(body.decode('utf-8')))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class CaptureServer(ThreadingMixIn, HTTPServer):
+    # A kept alive connection holds its handler thread, so it must not hold up shutdown
+    daemon_threads = True
+
+class ResponseEndpoint(object):
+    '''
+    Local stand-in for the pre-signed S3 url CloudFormation waits on
+    '''
+    def __enter__(self):
+        self.server = CaptureServer(('127.0.0.1', 0), CaptureHandler)
+        self.server.captured = []
+        self.url = 'http://127.0.0.1:{}/response'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+        cfnresponse.pool.clear()
+
+    @property
+    def captured(self):
+        return self.server.captured
+
+class HarnessContext(object):
+    log_stream_name = 'benchmark'
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 300000
+
+
+def cfn_event(url, action_obj, count):
+    return {
+        'RequestType': 'Create',
+        'StackId': 'arn:aws:cloudformation:us-east-1:123456789012:stack/benchmark/1',
+        'RequestId': 'request-{}'.format(count),
+        'LogicalResourceId': 'Benchmark',
+        'ResponseURL': url,
+        'ResourceProperties': {'Name': 'bench', 'Create': action_obj}
+    }
+
+def scenario_small(args):
+    action_obj = {
+        'PhysicalResourceId': '!Create[0].Resource.Id',
+        'Commands': [{'Client': 'ec2', 'Method': 'describe_things', 'Arguments': {'Name': '!event.ResourceProperties.Name'}}]
+    }
+    return action_obj, lambda method, arguments: synthetic_response(0, args.width)
+
+def scenario_many_commands(args):
+    action_obj = synthetic_event(args.commands, args.width)['ResourceProperties']['Create']
+    return action_obj, lambda method, arguments: synthetic_response(arguments['Count'], args.width)
+
+def scenario_large_response(args):
+    response = describe_instances_response(args.reservations)
+    action_obj = {
+        'PhysicalResourceId': '!Create[0].Reservations[].Instances[].InstanceId',
+        'ResponseData': {'LastImage': '!Create[0].Reservations[].Instances[].ImageId'},
+        'Commands': [{'Client': 'ec2', 'Method': 'describe_instances', 'Arguments': {}}]
+    }
+    return action_obj, lambda method, arguments: response
+
+def scenario_lookups(args):
+    commands = [{'Client': 'ec2', 'Method': 'describe_things', 'Arguments': {'Count': 0}}]
+    for i in range(1, args.commands):
+        arguments = dict(('Field{}'.format(n), '!Create[{}].Resource.Field{}'.format(i - 1, n)) for n in range(args.width))
+        arguments['Count'] = i
+        commands.append({'Client': 'ec2', 'Method': 'describe_things', 'Arguments': arguments})
+    action_obj = {
+        'PhysicalResourceId': '!Create[0].Resource.Id',
+        'ResponseData': dict(('Id{}'.format(i), '!Create[{}].!str.Resource.Count'.format(i)) for i in range(args.commands)),
+        'Commands': commands
+    }
+    return action_obj, lambda method, arguments: synthetic_response(arguments['Count'], args.width)
+
+SCENARIOS = {
+    'small': scenario_small,
+    'many_commands': scenario_many_commands,
+    'large_response': scenario_large_response,
+    'lookups': scenario_lookups,
+}
+
+PHASES = ['template_event', 'set_attributes_from_data', 'setup_session', 'validate', 'run_commands', '_send_status']
+
+@contextmanager
+def timed_phases(timings):
+    '''
+    Wraps each phase of CfnBotoInterface to add its run time to timings
+    '''
+    from lambda_function import CfnBotoInterface
+    originals = dict((phase, getattr(CfnBotoInterface, phase)) for phase in PHASES)
+    def timed(phase, method):
+        def wrapper(*args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                timings[phase] = timings.get(phase, 0.0) + timeit.default_timer() - start
+        return wrapper
+    for phase, method in originals.items():
+        setattr(CfnBotoInterface, phase, timed(phase, method))
+    try:
+        yield timings
+    finally:
+        for phase, method in originals.items():
+            setattr(CfnBotoInterface, phase, method)
+
+def run_scenario(name, args):
+    from checkpoint import MemoryStore
+    from clients import client_pool
+    from lambda_function import CfnBotoInterface, lambda_handler
+    # The stand-in clients call made up methods, there is no service model to check them against
+    CfnBotoInterface.check_models = False
+    # Checkpoints are kept in process like the clients, disk timings vary too much between machines
+    CfnBotoInterface.checkpoint_store = MemoryStore()
+    action_obj, responses = SCENARIOS[name](args)
+    session = StandInSession(responses)
+    client_pool.clear()
+    client_pool.sessions[(None, None)] = session
+    context = HarnessContext()
+    # cfnresponse prints the status of each send, keep it out of the results
+    with ResponseEndpoint() as endpoint, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        # Warm up, the first invocation builds the clients like a cold container would
+        lambda_handler(cfn_event(endpoint.url, action_obj, 0), context)
+        # Best of repeat batches, to keep noise out of the comparison with the baseline
+        elapsed = None
+        for batch in range(args.repeat):
+            batch_timings = {}
+            with timed_phases(batch_timings):
+                start = timeit.default_timer()
+                for count in range(args.invocations):
+                    lambda_handler(cfn_event(endpoint.url, action_obj, count), context)
+                batch_elapsed = timeit.default_timer() - start
+            if elapsed is None or batch_elapsed < elapsed:
+                elapsed, timings = batch_elapsed, batch_timings
+        # The api calls are counted for this one invocation, so they do not depend on repeat and invocations
+        calls = len(session.calls)
+        tracemalloc.start()
+        lambda_handler(cfn_event(endpoint.url, action_obj, 0), context)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        calls = len(session.calls) - calls
+        failed = [r['Reason'] for r in endpoint.captured if r['Status'] != 'SUCCESS']
+        response_bytes = len(json.dumps(endpoint.captured[-1]))
+    client_pool.clear()
+    return {
+        'invocations_per_second': args.invocations / elapsed,
+        'seconds_per_invocation': elapsed / args.invocations,
+        'phases': dict((phase, timings.get(phase, 0.0) / args.invocations) for phase in PHASES),
+        'peak_bytes': peak,
+        'api_calls': calls,
+        'response_bytes': response_bytes,
+        'failed': failed[:1]
+    }
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns the timings that are more than tolerance slower than the baseline,
+    failed invocations, and api calls or response sizes that changed at all
+    '''
+    regressions = []
+    for name, result in results.items():
+        if result.get('failed'):
+            regressions.append('{}.failed: {}'.format(name, result['failed'][0]))
+        if name not in baseline:
+            continue
+        for metric in ('api_calls', 'response_bytes'):
+            if metric in baseline[name] and result[metric] != baseline[name][metric]:
+                regressions.append('{}.{}: {}, baseline {}'.format(name, metric, result[metric], baseline[name][metric]))
+        metrics = [('seconds_per_invocation', result['seconds_per_invocation'], baseline[name]['seconds_per_invocation'])]
+        metrics += [(phase, result['phases'][phase], baseline[name]['phases'].get(phase, 0.0)) for phase in PHASES]
+        for metric, current, previous in metrics:
+            # Ignore sub-millisecond noise
+            if current > previous * (1 + tolerance) and current - previous > 0.0005:
+                regressions.append('{}.{}: {:.5f}s, baseline {:.5f}s'.format(name, metric, current, previous))
+    return regressions
+
+def bench_handler(args):
+    # Some scenarios go over the response limit on purpose, only the results are wanted
+    logger.setLevel(logging.CRITICAL)
+    names = [args.scenario] if args.scenario else sorted(SCENARIOS)
+    results = dict((name, run_scenario(name, args)) for name in names)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results['regressions'] = regressions
+    return results
+
+
+BENCHMARKS = {
+    'template': bench_template,
+    'traverse': bench_traverse,
+    'normalize': bench_normalize,
+    'modifiers': bench_modifiers,
+    'handler': bench_handler,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline benchmarks for cfn-boto-interface.')
+    parser.add_argument("benchmark", help="Benchmark to run.", choices=sorted(BENCHMARKS))
+    parser.add_argument("-c","--commands", help="Number of commands in the synthetic event.", type=int, default=20)
+    parser.add_argument("-w","--width", help="Number of static keys per command and response.", type=int, default=20)
+    parser.add_argument("-R","--reservations", help="Number of reservations in the synthetic describe_instances response, and of items in the DynamoDB one.", type=int, default=2000)
+    parser.add_argument("-V","--values", help="Number of values converted by each modifier.", type=int, default=100000)
+    parser.add_argument("-n","--repeat", help="Number of timed runs, the best is reported.", type=int, default=5)
+    parser.add_argument("-i","--invocations", help="Number of timed lambda_handler invocations per scenario.", type=int, default=20)
+    parser.add_argument("-s","--scenario", help="Handler scenario to run, all of them by default.", default=None, choices=sorted(SCENARIOS))
+    parser.add_argument("-b","--baseline", help="Baseline file handler results are compared against.", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json'))
+    parser.add_argument("-u","--update-baseline", help="Write handler results to the baseline file.", action='store_true')
+    parser.add_argument("-t","--tolerance", help="Fraction slower than the baseline that counts as a regression.", type=float, default=0.25)
+    args = parser.parse_args()
+    results = BENCHMARKS[args.benchmark](args)
+    print(json.dumps(results, indent=2))
+    # Non zero exit so CI can fail on a regression
+    if results.get('regressions'):
+        sys.exit(1)
@@ -0,0 +1,130 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from clients import client_pool
+from helper import hashed_path, json_serial, write_file
+from logger import logger
+
+# Only methods starting with one of these can be cached, they read without changing anything
+READ_ONLY_PREFIXES = ('describe_', 'get_', 'list_')
+CACHE_MAXSIZE = int(os.environ.get('CACHE_MAXSIZE', '256'))
+CACHE_DIR = os.environ.get('CACHE_DIR', '/tmp/cfn-boto-interface-cache')
+DEFAULT_TTL = 300.0
+
+
+def read_only(method):
+    return method.startswith(READ_ONLY_PREFIXES)
+
+
+class ResultCache(object):
+    '''
+    ResultCache memoizes the responses of read-only commands for as long as
+    the lambda container lives. Entries expire after their TTL and the least
+    recently used entry is evicted once maxsize is reached. Entries can also
+    be persisted under directory, so a container that recycles the /tmp
+    volume, or a local run, still finds them.
+    Cached responses are shared, they must be treated as read-only.
+    '''
+
+    def __init__(self, maxsize=256, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.accounts = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def account(self, session):
+        '''
+        Returns the account id of the session's credentials, looked up once per access key
+        '''
+        credentials = session.get_credentials()
+        access_key = credentials.get_frozen_credentials().access_key if credentials else None
+        with self.lock:
+            if access_key in self.accounts:
+                return self.accounts[access_key]
+        account = client_pool.client(session, 'sts').get_caller_identity()['Account']
+        with self.lock:
+            self.accounts[access_key] = account
+        return account
+
+    def key(self, session, service, method, arguments, options=None):
+        '''
+        Keys a call by account, region, client, method and its arguments
+        in canonical form, options are any that change the response
+        '''
+        return json.dumps(
+            [self.account(session), session.region_name, service, method, arguments, options],
+            sort_keys=True, separators=(',', ':'), default=json_serial
+        )
+
+    def get(self, key, persist=False):
+        '''
+        Returns (True, response) for a live entry, (False, None) otherwise
+        '''
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+        if persist and self.directory:
+            try:
+                with open(hashed_path(self.directory, key)) as f:
+                    expires, value = json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+            else:
+                if expires > now:
+                    self._store(key, expires, value)
+                    with self.lock:
+                        self.hits += 1
+                    return True, value
+        with self.lock:
+            self.misses += 1
+        return False, None
+
+    def put(self, key, value, ttl=DEFAULT_TTL, persist=False):
+        expires = time.time() + ttl
+        self._store(key, expires, value)
+        if persist and self.directory:
+            try:
+                encoded = json.dumps([expires, value], default=json_serial)
+            except TypeError as e:
+                logger.debug("Result Cache: Not persisting, response is not json: %s", e)
+                return
+            path = hashed_path(self.directory, key)
+            try:
+                write_file(path, encoded)
+            except (IOError, OSError) as e:
+                logger.warning("Result Cache: Unable to persist to %s: %s", path, e)
+
+    def _store(self, key, expires, value):
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.entries)
+        }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.accounts.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+result_cache = ResultCache(CACHE_MAXSIZE, CACHE_DIR)
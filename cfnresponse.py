@@ -1,19 +1,155 @@
 import json
+import random
+import threading
+import time
 
 try:
-    from urllib2 import HTTPError, build_opener, HTTPHandler, Request
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urlparse import urlsplit
 except ImportError:
-    from urllib.error import HTTPError
-    from urllib.request import build_opener, HTTPHandler, Request
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlsplit
 
 
 SUCCESS = "SUCCESS"
 FAILED = "FAILED"
+# CloudFormation rejects response bodies over 4KB
+RESPONSE_LIMIT = 4096
 
+# What send does with a response body over RESPONSE_LIMIT
+TRUNCATE = "Truncate"
+FAIL = "Fail"
 
-def send(event, context, response_status, reason=None, response_data=None, physical_resource_id=None):
+# Status codes from the response url worth another attempt
+RETRY_STATUS = set([429, 500, 502, 503, 504])
+
+
+class ConnectionPool(object):
+    '''
+    ConnectionPool keeps idle keep-alive connections per scheme and host,
+    so responses sent from a warm container skip the TCP and TLS handshake.
+    A connection is taken out of the pool while in use, so sends from
+    several threads never share one.
+    '''
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        '''
+        Returns a connection and whether it has been used before
+        '''
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        if scheme == 'https':
+            return HTTPSConnection(netloc, timeout=self.timeout), False
+        return HTTPConnection(netloc, timeout=self.timeout), False
+
+    def release(self, scheme, netloc, connection):
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append(connection)
+
+    def clear(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for connection in idle:
+                    connection.close()
+            self.idle.clear()
+
+pool = ConnectionPool()
+
+
+def encode(body):
+    return json.dumps(body, separators=(',', ':')).encode('ascii')
+
+
+def fit(body, limit=RESPONSE_LIMIT, oversize=TRUNCATE):
+    '''
+    Returns body encoded to at most limit bytes. With TRUNCATE the largest
+    Data entries are dropped, and named in the Reason, until it fits. With
+    FAIL an oversize body is replaced by a FAILED one giving its size.
+    '''
+    encoded = encode(body)
+    if len(encoded) <= limit:
+        return encoded
+    sizes = sorted(((len(encode(value)), key) for key, value in body['Data'].items()), reverse=True)
+    print("Response is {} bytes, over the {} byte limit, largest Data entries: {}".format(
+        len(encoded), limit, [(key, size) for size, key in sizes[:5]]))
+    if oversize == FAIL:
+        body = dict(body, Status=FAILED, Data={}, Reason="Response of {} bytes is over the {} byte limit, largest Data entries: {}".format(
+            len(encoded), limit, ', '.join(key for _, key in sizes[:5])))
+    else:
+        data = dict(body['Data'])
+        dropped = []
+        truncated = body
+        for _, key in sizes:
+            del data[key]
+            dropped.append(key)
+            truncated = dict(body, Data=data, Reason="{} (Data over {} bytes, dropped: {})".format(body['Reason'], limit, ', '.join(dropped)))
+            if len(encode(truncated)) <= limit:
+                break
+        body = truncated
+    encoded = encode(body)
+    if len(encoded) > limit:
+        # Only the Reason is left to shorten
+        over = len(encoded) - limit + 3
+        body = dict(body, Reason=body['Reason'][:-over] + '...')
+        encoded = encode(body)
+    return encoded
+
+
+def put(url, body, context=None, attempts=5, base_delay=0.5, reserve=1.0):
+    '''
+    PUTs body to url, retrying connection errors and throttling or server
+    errors with jittered exponential backoff. No retry is started that would
+    run into the last reserve seconds of the invocation. Returns True once
+    the url accepts the body, False if it never does.
+    '''
+    remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    end = time.time() + remaining() / 1000.0 - reserve if remaining is not None else None
+    parts = urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    headers = {'Content-Type': '', 'Content-Length': str(len(body))}
+    attempt = 0
+    while attempt < attempts:
+        connection, reused = pool.get(parts.scheme, parts.netloc)
+        try:
+            connection.request('PUT', path, body=body, headers=headers)
+            response = connection.getresponse()
+            # The body has to be read before the connection can be used again
+            response.read()
+        except (HTTPException, OSError) as exc:
+            connection.close()
+            if reused:
+                # The host closed the idle connection, a fresh one is not a retry
+                continue
+            error = "Failed executing HTTP request: {}".format(exc)
+        else:
+            pool.release(parts.scheme, parts.netloc, connection)
+            print("Status code: {}".format(response.status))
+            print("Status message: {}".format(response.reason))
+            if 200 <= response.status < 300:
+                return True
+            error = "Failed executing HTTP request: {}".format(response.status)
+            if response.status not in RETRY_STATUS:
+                print(error)
+                return False
+        attempt += 1
+        delay = random.uniform(0, base_delay * (2 ** (attempt - 1)))
+        if attempt == attempts or (end is not None and time.time() + delay > end):
+            break
+        print("{}, attempt {}, retrying in {:.2f}s".format(error, attempt, delay))
+        time.sleep(delay)
+    print(error)
+    return False
+
+
+def send(event, context, response_status, reason=None, response_data=None, physical_resource_id=None, oversize=TRUNCATE):
     response_data = response_data or {}
-    response_body = json.dumps(
+    response_body = fit(
         {
             'Status': response_status,
             'Reason': reason or "See the details in CloudWatch Log Stream: " + context.log_stream_name,
@@ -22,19 +158,7 @@ def send(event, context, response_status, reason=None, response_data=None, physi
             'RequestId': event['RequestId'],
             'LogicalResourceId': event['LogicalResourceId'],
             'Data': response_data
-        }
-    ).encode('ascii')
-
-    opener = build_opener(HTTPHandler)
-    request = Request(event['ResponseURL'], data=response_body)
-    request.add_header('Content-Type', '')
-    request.add_header('Content-Length', len(response_body))
-    request.get_method = lambda: 'PUT'
-    try:
-        response = opener.open(request)
-        print("Status code: {}".format(response.getcode()))
-        print("Status message: {}".format(response.msg))
-        return True
-    except HTTPError as exc:
-        print("Failed executing HTTP request: {}".format(exc.code))
-        return False
+        },
+        oversize=oversize
+    )
+    return put(event['ResponseURL'], response_body, context)
@@ -0,0 +1,236 @@
+import json
+import os
+import threading
+import time
+from clients import client_pool
+from helper import hashed_path, json_serial, write_file
+from logger import logger
+
+# file, file:<directory>, dynamodb:<table>, s3:<bucket>/<prefix> or none
+CHECKPOINT_STORE = os.environ.get('CHECKPOINT_STORE', 'file')
+# Seconds a checkpoint is kept, a redelivered event comes well within a day
+CHECKPOINT_TTL = int(os.environ.get('CHECKPOINT_TTL', '86400'))
+
+
+class CheckpointStore(object):
+    '''
+    CheckpointStore keeps the progress of a request, encoded as json, by its
+    RequestId so a redelivered event resumes where the last attempt stopped.
+    load returns None when there is nothing stored. expires is the epoch
+    time after which the progress is no longer needed.
+    '''
+    def load(self, key):
+        raise NotImplementedError
+
+    def save(self, key, body, expires):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class MemoryStore(CheckpointStore):
+    '''
+    Keeps checkpoints in process, a stand-in for the other stores in local runs
+    '''
+    def __init__(self):
+        self.states = {}
+
+    def load(self, key):
+        return self.states.get(key)
+
+    def save(self, key, body, expires):
+        self.states[key] = body
+
+    def delete(self, key):
+        self.states.pop(key, None)
+
+
+class FileStore(CheckpointStore):
+    '''
+    Keeps checkpoints as files in directory, /tmp by default. A warm container
+    that is invoked again with the same event finds them.
+    '''
+    def __init__(self, directory='/tmp/cfn-boto-interface-checkpoints'):
+        self.directory = directory
+
+    def load(self, key):
+        try:
+            with open(hashed_path(self.directory, key)) as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def save(self, key, body, expires):
+        write_file(hashed_path(self.directory, key), body)
+
+    def delete(self, key):
+        try:
+            os.remove(hashed_path(self.directory, key))
+        except (IOError, OSError):
+            pass
+
+
+class DynamoDBStore(CheckpointStore):
+    '''
+    Keeps checkpoints in a DynamoDB table with a string partition key named
+    RequestId. Expires can be made the table's TTL attribute. Items are
+    limited to 400KB, so this suits commands with pruned responses.
+    '''
+    def __init__(self, table, session=None):
+        self.table = table
+        self.session = session
+
+    def _client(self):
+        return client_pool.client(self.session or client_pool.session(), 'dynamodb')
+
+    def load(self, key):
+        item = self._client().get_item(TableName=self.table, Key={'RequestId': {'S': key}}, ConsistentRead=True).get('Item')
+        return item['State']['S'] if item else None
+
+    def save(self, key, body, expires):
+        self._client().put_item(TableName=self.table, Item={
+            'RequestId': {'S': key},
+            'State': {'S': body},
+            'Expires': {'N': str(expires)}
+        })
+
+    def delete(self, key):
+        self._client().delete_item(TableName=self.table, Key={'RequestId': {'S': key}})
+
+
+class S3Store(CheckpointStore):
+    '''
+    Keeps checkpoints as objects under prefix in an S3 bucket, a lifecycle
+    rule on the prefix can clean up the ones never deleted
+    '''
+    def __init__(self, bucket, prefix='', session=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.session = session
+
+    def _client(self):
+        return client_pool.client(self.session or client_pool.session(), 's3')
+
+    def _key(self, key):
+        return self.prefix + os.path.basename(hashed_path('', key))
+
+    def load(self, key):
+        client = self._client()
+        try:
+            body = client.get_object(Bucket=self.bucket, Key=self._key(key))['Body'].read()
+        except client.exceptions.NoSuchKey:
+            return None
+        return body.decode('utf-8')
+
+    def save(self, key, body, expires):
+        self._client().put_object(Bucket=self.bucket, Key=self._key(key), Body=body.encode('utf-8'))
+
+    def delete(self, key):
+        self._client().delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+def store_from(spec):
+    '''
+    Builds the store named by a CHECKPOINT_STORE value, None turns checkpoints off
+    '''
+    kind, _, location = spec.partition(':')
+    if kind == 'none':
+        return None
+    if kind == 'file':
+        return FileStore(location) if location else FileStore()
+    if kind == 'memory':
+        return MemoryStore()
+    if kind == 'dynamodb':
+        return DynamoDBStore(location)
+    if kind == 's3':
+        bucket, _, prefix = location.partition('/')
+        return S3Store(bucket, prefix)
+    logger.error("Unknown CHECKPOINT_STORE %s, using the file store", spec)
+    return FileStore()
+
+# Module level store, tests and local runs can swap in a MemoryStore
+store = store_from(CHECKPOINT_STORE)
+
+
+class Checkpoints(object):
+    '''
+    Checkpoints saves the progress of one request to a store after each
+    command, failures to save are logged rather than failing the command.
+    Take a sequence while building the state to save and pass it to save,
+    a state older than the last one saved is dropped, as is any save once
+    the checkpoint is deleted.
+    The Data and each response are encoded once and reused by later saves,
+    they must not change once saved. Data is the template snapshot taken
+    before any lookup resolves, on resume every lookup in it, the
+    PhysicalResourceId included, resolves again from the saved responses.
+    '''
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self.lock = threading.RLock()
+        # name to the object last encoded under it and its json
+        self.encoded = {}
+        self.issued = 0
+        self.saved = 0
+        self.deleted = False
+
+    def _encoded(self, name, value):
+        cached = self.encoded.get(name)
+        if cached is None or cached[0] is not value:
+            cached = self.encoded[name] = (value, json.dumps(value, default=json_serial))
+        return cached[1]
+
+    def encode(self, state, expires):
+        responses = ','.join(
+            '{}:{}'.format(json.dumps(name), self._encoded(name, response)) for name, response in state['Responses'].items()
+        )
+        return '{{"Data":{},"Responses":{{{}}},"Waiting":{},"Expires":{}}}'.format(
+            self._encoded('Data', state['Data']), responses, json.dumps(state['Waiting']), expires
+        )
+
+    def decode(self, body):
+        '''
+        Returns the state in body, None when it has expired
+        '''
+        state = json.loads(body)
+        if state.pop('Expires', 0) <= time.time():
+            return None
+        return state
+
+    def load(self):
+        try:
+            body = self.store.load(self.key)
+            return self.decode(body) if body else None
+        except Exception as e:
+            logger.warning("Checkpoint: Unable to load %s: %s", self.key, e)
+            return None
+
+    def sequence(self):
+        '''
+        Returns the number of a new save, later states get higher numbers
+        '''
+        with self.lock:
+            self.issued += 1
+            return self.issued
+
+    def save(self, state, sequence=None):
+        with self.lock:
+            if sequence is None:
+                sequence = self.sequence()
+            if self.deleted or sequence <= self.saved:
+                return
+            try:
+                expires = int(time.time() + CHECKPOINT_TTL)
+                self.store.save(self.key, self.encode(state, expires), expires)
+                self.saved = sequence
+            except Exception as e:
+                logger.warning("Checkpoint: Unable to save %s: %s", self.key, e)
+
+    def delete(self):
+        with self.lock:
+            self.deleted = True
+            try:
+                self.store.delete(self.key)
+            except Exception as e:
+                logger.warning("Checkpoint: Unable to delete %s: %s", self.key, e)
@@ -0,0 +1,164 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from logger import logger
+
+
+class ClientPool(object):
+    '''
+    ClientPool keeps boto3 sessions and clients alive at module level so they
+    are reused by every command in an invocation, and by later invocations
+    in a warm lambda container. Clients are keyed by service, region,
+    profile, credentials and client config, the least recently used client
+    is evicted once maxsize is reached.
+    '''
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.sessions = {}
+        self.assumed = {}
+        self.credentials = {}
+        self.role_locks = {}
+        self.clients = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        self.loader = None
+
+    def botocore_session(self):
+        '''
+        Returns a new botocore session sharing the pool's data loader, so
+        each service model is read from disk once however many sessions use it
+        '''
+        import botocore.loaders
+        import botocore.session
+        with self.lock:
+            if self.loader is None:
+                self.loader = botocore.loaders.create_loader()
+        session = botocore.session.get_session()
+        session.register_component('data_loader', self.loader)
+        return session
+
+    def session(self, profile=None, region=None):
+        '''
+        Returns a cached boto3 session for the profile and region
+        '''
+        key = (profile, region)
+        with self.lock:
+            if key not in self.sessions:
+                import boto3
+                self.sessions[key] = boto3.session.Session(
+                    botocore_session=self.botocore_session(), profile_name=profile, region_name=region
+                )
+            return self.sessions[key]
+
+    def regional_session(self, session, region):
+        '''
+        Returns the cached session for region with the same profile as session
+        '''
+        with self.lock:
+            profile = next((key[0] for key, value in self.sessions.items() if value is session), None)
+        return self.session(profile, region)
+
+    def assumed_session(self, session, role_arn, region=None, session_name='cfn-boto-interface', margin=300):
+        '''
+        Returns a session for region with role_arn assumed from session. The
+        role's credentials are cached until margin seconds before they expire,
+        and a session is kept for each region they are used in while they last.
+        '''
+        region = region or session.region_name
+        role = (session.profile_name, role_arn, session_name)
+        with self.lock:
+            role_lock = self.role_locks.setdefault(role, threading.Lock())
+        # One thread assumes the role, the rest wait for its credentials
+        with role_lock:
+            with self.lock:
+                credentials = self.credentials.get(role)
+                if credentials is not None and credentials['Expiration'] - margin <= time.time():
+                    credentials = None
+                if credentials is not None and (role, region) in self.assumed:
+                    return self.assumed[(role, region)]
+            if credentials is None:
+                logger.info("Client Pool: Assuming role: %s", role_arn)
+                response = self.client(session, 'sts').assume_role(RoleArn=role_arn, RoleSessionName=session_name)
+                credentials = dict(response['Credentials'], Expiration=response['Credentials']['Expiration'].timestamp())
+            import boto3
+            assumed = boto3.session.Session(
+                botocore_session=self.botocore_session(),
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken'],
+                region_name=region
+            )
+            with self.lock:
+                if self.credentials.get(role) is not credentials:
+                    # Sessions of the expired credentials go with them
+                    for key in [key for key in self.assumed if key[0] == role]:
+                        del self.assumed[key]
+                    self.credentials[role] = credentials
+                self.assumed[(role, region)] = assumed
+            return assumed
+
+    def _key(self, session, service, config):
+        credentials = session.get_credentials()
+        access_key = credentials.get_frozen_credentials().access_key if credentials else None
+        return (
+            service,
+            session.region_name,
+            session.profile_name,
+            access_key,
+            json.dumps(config, sort_keys=True) if config else None
+        )
+
+    def client(self, session, service, config=None, retries=True):
+        '''
+        Returns a client for service from the pool, building it from
+        session on a miss. config is a dict of botocore Config options.
+        retries False turns off botocore's own retries, for callers that
+        retry under a RetryPolicy, a retries option in config still wins.
+        '''
+        if not retries:
+            # botocore retrying inside each attempt would multiply the attempts, and ignore
+            # both the deadline and the service's token bucket
+            config = dict({'retries': {'max_attempts': 0}}, **(config or {}))
+        key = self._key(session, service, config)
+        with self.lock:
+            if key in self.clients:
+                self.hits += 1
+                self.clients.move_to_end(key)
+                return self.clients[key]
+            self.misses += 1
+            logger.debug("Client Pool: Building client: %s", key[:3])
+            if config:
+                from botocore.config import Config
+                client = session.client(service, config=Config(**config))
+            else:
+                client = session.client(service)
+            self.clients[key] = client
+            if len(self.clients) > self.maxsize:
+                self.clients.popitem(last=False)
+                self.evictions += 1
+            return client
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.clients),
+            'sessions': len(self.sessions),
+            'assumed': len(self.assumed)
+        }
+
+    def clear(self):
+        with self.lock:
+            self.sessions.clear()
+            self.assumed.clear()
+            self.credentials.clear()
+            self.clients.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+client_pool = ClientPool()
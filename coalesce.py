@@ -0,0 +1,168 @@
+import json
+import threading
+from command import Command
+from logger import logger
+
+
+class Batch(object):
+    '''
+    Batch describes how commands calling a method with one or a few ids can
+    be served by a single call of a method taking a list of them.
+    argument is the command's id argument, batch_argument the list argument
+    of the batched call and method the batched method, both default to the
+    command's. Items of the batched response are found in the list at
+    result, or in each of those items' nested list, and matched back to
+    the command by their key field. single names the response key a
+    command taking one id gets its item under. max_size is the most ids
+    the service accepts in one call.
+    '''
+    def __init__(self, argument, result, key, max_size, method=None, batch_argument=None, single=None, nested=None):
+        self.argument = argument
+        self.result = result
+        self.key = key
+        self.max_size = max_size
+        self.method = method
+        self.batch_argument = batch_argument or argument
+        self.single = single
+        self.nested = nested
+
+    def ids(self, arguments):
+        '''
+        Returns the ids the command asks for, or None if it can not be batched
+        '''
+        value = arguments.get(self.argument)
+        if self.single:
+            return [value] if isinstance(value, str) else None
+        if isinstance(value, list) and value and all(isinstance(i, str) for i in value):
+            return value
+        return None
+
+    def items(self, response):
+        for item in response.get(self.result, []):
+            if self.nested:
+                for child in item.get(self.nested, []):
+                    yield child
+            else:
+                yield item
+
+    def split(self, response, ids):
+        '''
+        Returns the response the command would have had on its own, or None
+        when the batched response is missing one of its ids
+        '''
+        wanted = set(ids)
+        found = set(item.get(self.key) for item in self.items(response)) & wanted
+        if found != wanted:
+            return None
+        own = dict((k, v) for k, v in response.items() if k != self.result and not k.startswith('Invalid'))
+        if self.single:
+            own[self.single] = next(item for item in self.items(response) if item.get(self.key) == ids[0])
+        elif self.nested:
+            own[self.result] = []
+            for item in response.get(self.result, []):
+                children = [child for child in item.get(self.nested, []) if child.get(self.key) in wanted]
+                if children:
+                    own[self.result].append(dict(item, **{self.nested: children}))
+        else:
+            own[self.result] = [item for item in response.get(self.result, []) if item.get(self.key) in wanted]
+        return own
+
+
+# (Client, Method) of commands that can be coalesced, register adds to it
+BATCHABLE = {
+    ('ec2', 'describe_images'): Batch('ImageIds', 'Images', 'ImageId', 200),
+    ('ec2', 'describe_instances'): Batch('InstanceIds', 'Reservations', 'InstanceId', 200, nested='Instances'),
+    ('ec2', 'describe_subnets'): Batch('SubnetIds', 'Subnets', 'SubnetId', 200),
+    ('ec2', 'describe_vpcs'): Batch('VpcIds', 'Vpcs', 'VpcId', 200),
+    ('ec2', 'describe_security_groups'): Batch('GroupIds', 'SecurityGroups', 'GroupId', 200),
+    ('ec2', 'describe_volumes'): Batch('VolumeIds', 'Volumes', 'VolumeId', 200),
+    ('ssm', 'get_parameter'): Batch('Name', 'Parameters', 'Name', 10, method='get_parameters', batch_argument='Names', single='Parameter'),
+    ('ssm', 'get_parameters'): Batch('Names', 'Parameters', 'Name', 10),
+}
+
+# Commands with any other option are run on their own
+COALESCE_KEYS = set(['Client', 'Method', 'Arguments', 'Retry', 'Config'])
+
+
+def register(client, method, batch):
+    BATCHABLE[(client, method)] = batch
+
+
+class CoalescedCall(object):
+    '''
+    CoalescedCall makes the batched calls for a group of commands the first
+    time any of them asks for its response, the rest get theirs from it.
+    A command whose ids are missing from the batched response, or every
+    command when a batched call fails, is run on its own instead, so it
+    fails or succeeds as it would have without coalescing.
+    '''
+    def __init__(self, session, cmd, batch, members):
+        self.session = session
+        self.cmd = cmd
+        self.batch = batch
+        # command index to the ids it asks for
+        self.members = members
+        self.lock = threading.Lock()
+        self.responses = None
+
+    def _call(self, deadline):
+        ids = []
+        for count in sorted(self.members):
+            ids.extend(i for i in self.members[count] if i not in ids)
+        arguments = dict((k, v) for k, v in self.cmd['Arguments'].items() if k != self.batch.argument)
+        cmd = dict(self.cmd, Method=self.batch.method or self.cmd['Method'])
+        merged = {}
+        for start in range(0, len(ids), self.batch.max_size):
+            chunk = dict(arguments, **{self.batch.batch_argument: ids[start:start + self.batch.max_size]})
+            response = Command(self.session, dict(cmd, Arguments=chunk)).run(deadline)
+            for key, value in response.items():
+                if isinstance(value, list):
+                    merged.setdefault(key, []).extend(value)
+                else:
+                    merged[key] = value
+        logger.info("Coalesced %s %s.%s commands into %s calls", len(self.members), self.cmd['Client'], self.cmd['Method'],
+                    (len(ids) - 1) // self.batch.max_size + 1)
+        return merged
+
+    def response(self, count, command, deadline=None):
+        with self.lock:
+            if self.responses is None:
+                try:
+                    merged = self._call(deadline)
+                    self.responses = dict((i, self.batch.split(merged, ids)) for i, ids in self.members.items())
+                except Exception as e:
+                    logger.warning("Coalesced call %s.%s failed, running its commands on their own: %s", self.cmd['Client'], self.cmd['Method'], e)
+                    self.responses = {}
+        response = self.responses.get(count)
+        if response is None:
+            return command.run(deadline)
+        return response
+
+
+def coalesce(session, commands, ready):
+    '''
+    Groups the commands in ready, those with nothing to wait on, that call
+    the same batchable method with the same options. Returns a dict of each
+    grouped command's index to the CoalescedCall serving it.
+    '''
+    groups = {}
+    for count in ready:
+        cmd = commands[count]
+        if not isinstance(cmd, dict) or not set(cmd) <= COALESCE_KEYS or not isinstance(cmd.get('Arguments'), dict):
+            continue
+        batch = BATCHABLE.get((cmd.get('Client'), cmd.get('Method')))
+        if batch is None:
+            continue
+        ids = batch.ids(cmd['Arguments'])
+        if ids is None:
+            continue
+        shared = dict(cmd, Arguments=dict((k, v) for k, v in cmd['Arguments'].items() if k != batch.argument))
+        key = json.dumps(shared, sort_keys=True, default=str)
+        groups.setdefault(key, (cmd, batch, {}))[2][count] = ids
+    coalesced = {}
+    for cmd, batch, members in groups.values():
+        if len(members) > 1:
+            call = CoalescedCall(session, cmd, batch, members)
+            for count in members:
+                coalesced[count] = call
+    return coalesced
@@ -1,3 +1,19 @@
+import re
+import metrics
+import retry
+from cache import DEFAULT_TTL, READ_ONLY_PREFIXES, read_only, result_cache
+from clients import client_pool
+from continuation import Suspend
+from helper import find_all, lookup, to_bool, to_options
+from logger import logger
+from normalize import STREAM_AS, read_streams, stream_options
+from retry import RetryPolicy
+from scheduler import run_graph
+
+# Options of a command that fans out, the commands run in each region and account do not have them
+FAN_OUT_KEYS = ('Region', 'RoleArn', 'RoleSessionName', 'MaxConcurrency')
+ROLE_ARN = re.compile(r'^arn:[\w-]+:iam::(\d{12}):role/.+$')
+
 class Command(object):
     '''
     Command validates each command object in the Commands array. 
@@ -8,24 +24,259 @@ class Command(object):
     method = None
 
     def __init__(self,session,cmd):
-        self._validate(cmd)
-        self.session = session
+        self.validate(cmd)
+        self.cmd = cmd
         self.arguments = cmd['Arguments']
-        self.client = cmd['Client']
+        self.service = cmd['Client']
         self.method = cmd['Method']
-        self.client = self.session.client(cmd['Client'])
+        self.config = cmd.get('Config', None)
+        self.paginate = to_options(cmd.get('Paginate', None))
+        self.retry = RetryPolicy.from_command(cmd.get('Retry', None))
+        self.wait_options = cmd.get('Wait', None)
+        self.cache = to_options(cmd.get('Cache', None))
+        self.stream = stream_options(cmd.get('Stream', None))
+        self.targets = self._targets(cmd)
+        if self.targets is not None:
+            # A command with a list of regions or roles runs as a command per target
+            self.session = session
+            self.client = None
+            return
+        # A single Region or RoleArn moves the command to that region or account
+        self.session = self._target_session(session,cmd.get('RoleArn',None),cmd.get('Region',None))
+        # Clients come from the module level pool, so they are shared across commands and warm invocations
+        with metrics.span('client',Service=self.service):
+            self.client = client_pool.client(self.session,cmd['Client'],self.config,retries=False)
 
-    def _validate(self,cmd_obj):
+    @classmethod
+    def validate(cls,cmd_obj,pending=()):
+        '''
+        Asserts the command object is well formed, used by validate_plan before anything runs.
+        pending holds the paths in the command that are lookups still to be resolved,
+        their types are only known once they are
+        '''
+        given = lambda *path: path not in pending
         assert type(cmd_obj) is dict, "Command Object must be of type dict"
         assert 'Client' in cmd_obj, "Command Object must have 'Client' key"
-        assert type(cmd_obj['Client']) is str, "Client must be of type str"
+        assert type(cmd_obj['Client']) is str or not given('Client'), "Client must be of type str"
         assert 'Method' in cmd_obj, "Command Object must have 'Method' key"
-        assert type(cmd_obj['Method']) is str, "Method must be of type str"
+        assert type(cmd_obj['Method']) is str or not given('Method'), "Method must be of type str"
         assert 'Arguments' in cmd_obj, "Command Object must have 'Arguments' key"
-        assert type(cmd_obj['Arguments']) is dict, "Arguments must be of type dict"
+        assert type(cmd_obj['Arguments']) is dict or not given('Arguments'), "Arguments must be of type dict"
+        assert type(cmd_obj.get('Config',{})) is dict or not given('Config'), "Config must be of type dict"
+        paginate = cmd_obj.get('Paginate',None)
+        if type(paginate) is dict:
+            assert type(paginate.get('Collect',{})) is dict or not given('Paginate','Collect'), "Paginate Collect must be of type dict"
+            for option in ['MaxItems', 'MaxPages', 'PageSize']:
+                if option in paginate and given('Paginate',option):
+                    assert str(paginate[option]).isdigit() and int(paginate[option]) > 0, "Paginate {} must be a positive int".format(option)
+        assert type(cmd_obj.get('Retry',{})) in [dict,str,bool] or not given('Retry'), "Retry must be of type dict, str or bool"
+        if 'Wait' in cmd_obj and given('Wait'):
+            assert type(cmd_obj['Wait']) is dict, "Wait must be of type dict"
+            assert 'Waiter' in cmd_obj['Wait'] or 'Path' in cmd_obj['Wait'], "Wait must have 'Waiter' or 'Path' key"
+            assert 'Waiter' in cmd_obj['Wait'] or 'Success' in cmd_obj['Wait'], "Wait with 'Path' must have 'Success' key"
+        stream = stream_options(cmd_obj.get('Stream',None)) if given('Stream') else None
+        if stream is not None:
+            assert stream.get('As','Text') in STREAM_AS or not given('Stream','As'), "Stream must be one of {}".format(', '.join(STREAM_AS))
+            if given('Stream','MaxBytes'):
+                assert str(stream.get('MaxBytes',1)).isdigit() and int(stream.get('MaxBytes',1)) > 0, "Stream MaxBytes must be a positive int"
+        if given('Cache') and given('Method') and to_options(cmd_obj.get('Cache',None)) is not None:
+            assert read_only(cmd_obj['Method']), "Cache is only allowed for methods starting with {}".format(', '.join(READ_ONLY_PREFIXES))
+        for key in ['Region', 'RoleArn']:
+            if not given(key):
+                continue
+            values = cmd_obj.get(key,[])
+            indexed = values if isinstance(values,list) else [values]
+            assert indexed or key not in cmd_obj, "{} list must not be empty".format(key)
+            values = [value for index,value in enumerate(indexed) if not isinstance(values,list) or given(key,index)]
+            assert all(type(value) is str for value in values), "{} must be of type str or list of str".format(key)
+            if key == 'RoleArn':
+                for role in values:
+                    assert ROLE_ARN.match(role), "RoleArn {} is not an IAM role arn".format(role)
+        if isinstance(cmd_obj.get('Region',None),list) or isinstance(cmd_obj.get('RoleArn',None),list):
+            assert 'Wait' not in cmd_obj, "Wait can not be used with a list of Region or RoleArn"
+            if given('MaxConcurrency'):
+                assert str(cmd_obj.get('MaxConcurrency',1)).isdigit() and int(cmd_obj.get('MaxConcurrency',1)) > 0, "MaxConcurrency must be a positive int"
+
+    @staticmethod
+    def _targets(cmd):
+        '''
+        Returns [(keys, role, region)] for a command with a list of Region or
+        RoleArn, one for each account and region it runs in. keys place the
+        target's response in the result, by account id then region.
+        None for a command that does not fan out.
+        '''
+        regions, roles = cmd.get('Region',None), cmd.get('RoleArn',None)
+        if not isinstance(regions,list) and not isinstance(roles,list):
+            return None
+        targets = []
+        for role in roles if isinstance(roles,list) else [roles]:
+            for region in regions if isinstance(regions,list) else [regions]:
+                keys = ()
+                if isinstance(roles,list):
+                    keys += (ROLE_ARN.match(role).group(1),)
+                if isinstance(regions,list):
+                    keys += (region,)
+                targets.append((keys,role,region))
+        return targets
+
+    def _target_session(self,session,role,region):
+        if role:
+            return client_pool.assumed_session(session,role,region,self.cmd.get('RoleSessionName','cfn-boto-interface'))
+        if region and region != session.region_name:
+            return client_pool.regional_session(session,region)
+        return session
+
+
+
+    def run(self,deadline=None):
+        '''
+        Runs the command, with Cache the response comes from the result cache
+        while it is there, and is stored in it when it is not
+        '''
+        if self.targets is not None:
+            return self._fan_out(deadline)
+        if self.cache is None:
+            return self._call(deadline)
+        persist = to_bool(self.cache.get('Persist', False))
+        with metrics.span('cache',Service=self.service,Method=self.method) as span:
+            # A body is cached as what it reads as, so the Stream options are part of the key
+            key = result_cache.key(self.session,self.service,self.method,self.arguments,{'Paginate':self.paginate,'Stream':self.stream})
+            hit, response = result_cache.get(key,persist)
+            span.set('Hit',hit)
+        if hit:
+            logger.info("Result Cache: Hit for %s.%s", self.service, self.method)
+            return response
+        # A streaming body can only be read once, it is cached as what it reads as
+        response = read_streams(self._call(deadline),self.stream)
+        result_cache.put(key,response,float(self.cache.get('TTL', DEFAULT_TTL)),persist)
+        return response
 
+    def _fan_out(self,deadline=None):
+        '''
+        Runs the command in every target at once, at most MaxConcurrency at a
+        time, returns the responses keyed by account id and then region
+        '''
+        cmd = dict((k,v) for k,v in self.cmd.items() if k not in FAN_OUT_KEYS)
+        responses = {}
+        def run(count):
+            keys, role, region = self.targets[count]
+            command = Command(self._target_session(self.session,role,region),cmd)
+            responses[count] = command.run(deadline)
+        max_concurrency = int(self.cmd.get('MaxConcurrency', 8))
+        run_graph(run,dict((count,set()) for count in range(len(self.targets))),max_concurrency,deadline)
+        logger.info("Ran %s.%s in %s targets", self.service, self.method, len(self.targets))
+        result = {}
+        for count, (keys, role, region) in enumerate(self.targets):
+            parent = result
+            for key in keys[:-1]:
+                parent = parent.setdefault(key,{})
+            parent[keys[-1]] = responses[count]
+        return result
 
-    def run(self):
-        response = getattr(self.client,self.method)(**self.arguments)
+    def _call(self,deadline=None):
+        '''
+        Runs the command under its retry policy, retries stop once deadline runs out
+        '''
+        if self.paginate is not None:
+            call = self._run_paginated
+        else:
+            call = lambda: getattr(self.client,self.method)(**self.arguments)
+        with metrics.span('api_call',Service=self.service,Method=self.method) as span:
+            try:
+                response = self.retry.call(call,self.service,deadline)
+            finally:
+                span.set('Attempts',self.retry.attempts)
+        if self.stream is not None:
+            # Read now so lookups can reach into a body read As Json, without
+            # Stream a body is only read if a lookup keeps it
+            response = read_streams(response,self.stream)
         return response
 
+    def _run_paginated(self):
+        '''
+        Runs the method through a botocore paginator, folding each page into the
+        result as it arrives so the full set of pages is never held at once.
+        With Collect only the values at each named path are kept, without it
+        list values are appended across pages and the last value wins otherwise.
+        '''
+        assert self.client.can_paginate(self.method), "Method {} can not be paginated".format(self.method)
+        collect = self.paginate.get('Collect', None)
+        max_pages = self.paginate.get('MaxPages', None)
+        pagination_config = {}
+        for option in ['MaxItems', 'PageSize']:
+            if option in self.paginate:
+                pagination_config[option] = int(self.paginate[option])
+        pages = self.client.get_paginator(self.method).paginate(PaginationConfig=pagination_config, **self.arguments)
+
+        result = dict((name, []) for name in collect) if collect else {}
+        count = 0
+        for page in pages:
+            if collect:
+                for name, path in collect.items():
+                    result[name].extend(find_all(page, path))
+            else:
+                for key, value in page.items():
+                    if isinstance(value, list):
+                        result.setdefault(key, []).extend(value)
+                    else:
+                        result[key] = value
+            count = count + 1
+            if max_pages is not None and count >= int(max_pages):
+                break
+        logger.info("Paginated %s over %s pages", self.method, count)
+        result['PageCount'] = count
+        if pages.resume_token:
+            result['NextToken'] = pages.resume_token
+        return result
+
+
+
+    def wait(self,deadline=None,attempts=0):
+        '''
+        Waits for the command to finish, with a botocore waiter when Wait has a
+        Waiter, or by polling Method until the value at Path is one of Success.
+        attempts is how many checks an earlier invocation already made.
+        Raises Suspend instead of sleeping past the deadline.
+        '''
+        options = self.wait_options
+        delay = float(options.get('Delay', 15))
+        max_attempts = int(options.get('MaxAttempts', 40))
+        arguments = options.get('Arguments', self.arguments)
+        while attempts < max_attempts:
+            attempts = attempts + 1
+            if self._check(options, arguments):
+                logger.info("Wait for %s finished after %s attempts", self.method, attempts)
+                return attempts
+            if attempts >= max_attempts:
+                break
+            if deadline is not None and deadline.remaining() <= delay:
+                raise Suspend(attempts, "Out of time waiting on {}, suspending after {} attempts".format(self.method, attempts))
+            retry.default_clock.sleep(delay)
+        raise Exception("Wait for {} did not finish after {} attempts".format(self.method, max_attempts))
+
+    def _check(self,options,arguments):
+        '''
+        Makes a single wait check, True when done, raises when it will never be done
+        '''
+        if 'Waiter' in options:
+            from botocore.exceptions import WaiterError
+            waiter = self.client.get_waiter(options['Waiter'])
+            try:
+                waiter.wait(WaiterConfig={'Delay': 0, 'MaxAttempts': 1}, **arguments)
+                return True
+            except WaiterError as e:
+                if 'Max attempts exceeded' in str(e):
+                    return False
+                raise
+        method = options.get('Method', self.method)
+        response = self.retry.call(lambda: getattr(self.client,method)(**arguments),self.service)
+        value = lookup(response, options['Path'])
+        logger.info("Wait for %s: %s is %s", self.method, options['Path'], value)
+        if str(value) in self._states(options.get('Failure', [])):
+            raise Exception("Wait for {} failed: {} is {}".format(self.method, options['Path'], value))
+        return str(value) in self._states(options.get('Success', []))
+
+    def _states(self,states):
+        if isinstance(states, list):
+            return [str(state) for state in states]
+        return [str(states)]
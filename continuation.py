@@ -0,0 +1,80 @@
+import json
+from clients import client_pool
+from helper import json_serial
+from logger import logger
+
+# Key the saved progress is carried under in a continuation event
+CONTINUATION_KEY = '__Continuation'
+
+
+class Suspend(Exception):
+    '''
+    Raised by a command that has to keep waiting but is running out of time.
+    attempts is how many wait attempts it has made so far.
+    '''
+    def __init__(self, attempts, message="Out of time, suspending"):
+        super(Suspend, self).__init__(message)
+        self.attempts = attempts
+
+
+def continuation_state(data, responses, waiting):
+    '''
+    Builds the saved progress of a request. data is the templated event
+    data, responses the completed Action[i] results and waiting the wait
+    attempts made so far by each command still waiting.
+    '''
+    return {
+        'Data': data,
+        'Responses': responses,
+        'Waiting': dict((str(count), attempts) for count, attempts in waiting.items())
+    }
+
+
+def continuation_event(event, data, responses, waiting):
+    '''
+    Builds the event the function re-invokes itself with, carrying its progress
+    '''
+    event = dict((k, v) for k, v in event.items() if k != CONTINUATION_KEY)
+    event[CONTINUATION_KEY] = continuation_state(data, responses, waiting)
+    return event
+
+
+class LambdaInvoker(object):
+    '''
+    Re-invokes the running lambda function asynchronously.
+    The function's role needs lambda:InvokeFunction on itself.
+    '''
+    def __init__(self, session):
+        self.session = session
+
+    def invoke(self, context, event):
+        payload = json.dumps(event, default=json_serial)
+        logger.info("Re-invoking %s with %s bytes of progress", context.invoked_function_arn, len(payload))
+        client = client_pool.client(self.session, 'lambda')
+        client.invoke(FunctionName=context.invoked_function_arn, InvocationType='Event', Payload=payload)
+
+
+class LocalInvoker(object):
+    '''
+    In process stand-in for LambdaInvoker, used when running locally.
+    Continuation events are queued, then run by drain once the current
+    invocation has returned, the way an async invoke would.
+    '''
+    def __init__(self, handler):
+        self.handler = handler
+        self.queue = []
+        self.invocations = 0
+
+    def invoke(self, context, event):
+        # Round trip through json so the event is what lambda would have delivered
+        self.queue.append((context, json.loads(json.dumps(event, default=json_serial))))
+
+    def drain(self):
+        while self.queue:
+            context, event = self.queue.pop(0)
+            # Each continuation gets a fresh timeout, as a new invocation would
+            if hasattr(context, 'reset'):
+                context.reset()
+            self.invocations += 1
+            logger.info("Local Invoker: Running continuation %s", self.invocations)
+            self.handler(event, context)
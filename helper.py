@@ -1,56 +1,126 @@
+import base64
+import hashlib
+import json
+import os
 import random
+import re
 import string
-from datetime import date, datetime
+import threading
 from logger import logger
+from normalize import PASS_TYPES, normalize_value
 
 ####
-# The recursion and traversal was taken, and adapted slightly from nvie.com blog:
+# The traversal was originally taken, and adapted slightly from nvie.com blog:
 # http://nvie.com/posts/modifying-deeply-nested-structures/
+# It has since been made iterative, and copy on write so untouched subtrees
+# are shared with the original rather than rebuilt on every call.
 ######
+def _rebuild(container, values):
+    '''
+    Returns container if none of its values changed, a copy holding values if they did
+    '''
+    if isinstance(container, dict):
+        if all(new is old for new, old in zip(values, container.values())):
+            return container
+        return dict(zip(container.keys(), values))
+    if all(new is old for new, old in zip(values, container)):
+        return container
+    return values
+
 def traverse(obj, path=None, callback=None):
     """
     Traverse an arbitrary Python object structure (limited to JSON data
     types), calling a callback function for every element in the structure,
     and inserting the return value of the callback as the new value.
+    Containers are only copied when the callback changed something below
+    them. The path list handed to the callback is reused between calls.
     """
-    if path is None:
-        path = []
-
-    if isinstance(obj, dict):
-        value = {k: traverse(v, path + [k], callback)
-                 for k, v in obj.items()}
-    elif isinstance(obj, list):
-        value = [traverse(elem, path + [[]], callback)
-                 for elem in obj]
-    else:
-        value = obj
-
     if callback is None:
-        return value
-    else:
-        return callback(path, value)
+        return obj
+    if not isinstance(obj, (dict, list)):
+        return callback([] if path is None else path, obj)
+    path = [] if path is None else list(path)
+    push, pop = path.append, path.pop
+    stack = [(obj, iter(obj.items()) if isinstance(obj, dict) else iter(obj), [])]
+    while True:
+        container, children, values = stack[-1]
+        keyed = isinstance(container, dict)
+        for child in children:
+            if keyed:
+                key, child = child
+                push(key)
+            else:
+                push([])
+            # Descend into a child container, its parent picks up where it left off after
+            if isinstance(child, dict):
+                stack.append((child, iter(child.items()), []))
+                break
+            if isinstance(child, list):
+                stack.append((child, iter(child), []))
+                break
+            values.append(callback(path, child))
+            pop()
+        else:
+            stack.pop()
+            value = callback(path, _rebuild(container, values))
+            if not stack:
+                return value
+            stack[-1][2].append(value)
+            pop()
+
+def _modify(node, target_path, depth, action):
+    if depth == len(target_path):
+        return action(node)
+    part = target_path[depth]
+    if isinstance(part, list):
+        if not isinstance(node, list):
+            return node
+        return _rebuild(node, [_modify(elem, target_path, depth + 1, action) for elem in node])
+    if isinstance(node, dict) and part in node:
+        value = _modify(node[part], target_path, depth + 1, action)
+        if value is node[part]:
+            return node
+        node = dict(node)
+        node[part] = value
+    return node
 
 def traverse_modify(obj, target_path, action):
     """
     Traverses an arbitrary object structure and where the path matches,
     performs the given action on the value, replacing the node with the
-    action's return value.
+    action's return value. Only the branches leading to the target are
+    walked, and only those are copied.
     """
     target_path = to_path(target_path)
+    logger.debug("Traverse Modify: Target Path: %s", target_path)
+    return _modify(obj, target_path, 0, action)
 
-    def transformer(path, value):
-        logger.debug("Transformer: Path: {}".format(path))
-        logger.debug("Transformer: Path: Type: {}".format(type(path)))
-        logger.debug("Transformer: Target Path: {}".format(target_path))
-        logger.debug("Transformer: Target Path: Type: {}".format(type(target_path)))
-        logger.debug("Transformer: Value: {}".format(value))
-        logger.debug("Transformer: Value: Type: {}".format(type(value)))
-        if path == target_path:
-            return action(value)
-        else:
-            return value
+def find_all(obj, path):
+    '''
+    Returns every value found at path in obj, in order. A [] in the path
+    fans out over each element of the list at that point.
+    '''
+    nodes = [obj]
+    for part in to_path(path):
+        found = []
+        for node in nodes:
+            if isinstance(part, list):
+                if isinstance(node, list):
+                    found.extend(node)
+            elif isinstance(node, dict) and part in node:
+                found.append(node[part])
+        nodes = found
+    return nodes
 
-    return traverse(obj, callback=transformer)
+def lookup(obj, path):
+    '''
+    Returns the value found at path in obj, None if nothing is found.
+    Where a [] in the path matches many values the last one is returned.
+    '''
+    nodes = find_all(obj, path)
+    if nodes:
+        return nodes[-1]
+    return None
 
 def traverse_find(obj, trigger, action):
     # This will get called for every path/value in the structure
@@ -87,41 +157,351 @@ def to_path(path):
 
 def json_serial(obj):
     """JSON serializer for objects not serializable by default json code"""
+    return normalize_value(obj)
+
+####
+# Response pruning
+# Keeps only the parts of a response that lookups reference, and makes
+# only those parts json serializable.
+######
+_ANY = object()
+_KEEP = object()
+_MISSING = object()
+
+def _prune(obj, trie):
+    '''
+    Returns obj cut down to the paths in trie, and the ids of the paths found in it
+    '''
+    kept = _MISSING
+    found = set()
+    if isinstance(obj, list) and _ANY in trie:
+        # Lookups take the last match for a [], so an element is only kept
+        # while it is the last match of at least one path
+        kept = []
+        for elem in reversed(obj):
+            value, ids = _prune(elem, trie[_ANY])
+            if ids - found:
+                kept.append(value)
+                found |= ids
+        kept.reverse()
+    elif isinstance(obj, dict):
+        kept = {}
+        for part, sub in trie.items():
+            if part is not _ANY and part is not _KEEP and part in obj:
+                value, ids = _prune(obj[part], sub)
+                if ids:
+                    kept[part] = value
+                    found |= ids
+    if _KEEP in trie:
+        # A path ends here, everything below is kept
+        return obj, found | trie[_KEEP]
+    if found:
+        return kept, found
+    return _MISSING, found
+
+def prune(obj, paths):
+    '''
+    Returns a copy of obj holding only what lookups of paths can reach
+    '''
+    trie = {}
+    for i, path in enumerate(paths):
+        node = trie
+        for part in to_path(path):
+            node = node.setdefault(_ANY if isinstance(part, list) else part, {})
+        node.setdefault(_KEEP, set()).add(i)
+    pruned, ids = _prune(obj, trie)
+    if pruned is _MISSING:
+        return {}
+    return pruned
 
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    if isinstance(obj, None):
-        return 'None'
-    raise TypeError ("Type %s not serializable" % type(obj))
+def serializable(obj, stream=None):
+    '''
+    Returns obj with every value json can not encode converted by its type's
+    handler in normalize, containers with nothing to convert are shared with
+    obj. stream are the options streaming bodies are read with.
+    '''
+    def serialize(path, value):
+        if type(value) in PASS_TYPES:
+            return value
+        return normalize_value(value, stream)
+    return traverse(obj, callback=serialize)
+
+# CloudFormation passes booleans as strings
+def to_bool(value):
+    return str(value).lower() in ('true', '1', 'yes')
+
+def to_options(value):
+    '''
+    Options like Paginate and Cache can be a bool, or a dict of settings.
+    Returns the dict, {} for true, None when the option is off.
+    '''
+    if isinstance(value, dict):
+        return value
+    if to_bool(value):
+        return {}
+    return None
+
+def hashed_path(directory, key):
+    '''
+    Returns the path of the json file kept for key in directory
+    '''
+    return os.path.join(directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+def write_file(path, text):
+    '''
+    Writes text to path, creating its directory. The text is written to a
+    temporary file then renamed, so a reader never sees half of it.
+    '''
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp = "{}.{}.{}".format(path, os.getpid(), threading.current_thread().ident)
+    with open(temp, 'w') as f:
+        f.write(text)
+    os.rename(temp, path)
 
 # Trims prefix
 def remove_prefix(text, prefix):
     return text[text.startswith(prefix) and len(prefix):]
 
-# returns the modifier and text without modifier syntax
-def return_modifier(text):
-    modifiers = [ 'str', 'int' ]
-    for mod in modifiers:
-        mod_syntax = "!{}.".format(mod)
-        if mod_syntax in text:
-            return (mod,text.replace(mod_syntax,''))
-    return (None,text)
-
 # Injects random alphanumeric into value where trigger is found
 def inject_rand(text, trigger):
     while trigger in text:
         text = text.replace(trigger,''.join(random.choices(string.ascii_uppercase + string.digits, k=4)),1)
     return text
 
-def convert(value, type_):
-    import importlib
-    try:
-        # Check if it's a builtin type
-        module = importlib.import_module('builtins')
-        cls = getattr(module, type_)
-    except AttributeError:
-        # if not, separate module and class
-        module, type_ = type_.rsplit(".", 1)
-        module = importlib.import_module(module)
-        cls = getattr(module, type_)
-    return cls(value)
+
+####
+# Modifiers
+# A value or lookup can start with a chain of !name. modifiers, applied in
+# order to what it resolves to. !name(argument). passes argument along too.
+# Each chain is bound into a single callable once, when it is compiled.
+######
+def _int(value, base=None):
+    # !int(16). reads a hex string
+    if base is None:
+        return int(value)
+    return int(value, int(base))
+
+def _bool(value):
+    # CloudFormation passes booleans as strings
+    if isinstance(value, str):
+        return to_bool(value)
+    return bool(value)
+
+def _json(value):
+    # Parses a json string, a value boto3 already parsed is passed through
+    if isinstance(value, (str, bytes, bytearray)):
+        return json.loads(value)
+    return value
+
+def _tojson(value):
+    return json.dumps(value, separators=(',', ':'), default=json_serial)
+
+def _b64(value):
+    if not isinstance(value, (bytes, bytearray)):
+        value = str(value).encode('utf-8')
+    return base64.b64encode(value).decode('ascii')
+
+def _join(value, separator=','):
+    return separator.join(str(item) for item in value)
+
+MODIFIER = re.compile(r'!(\w+)(?:\(([^)]*)\))?\.')
+MODIFIERS = {
+    'str': str,
+    'int': _int,
+    'float': float,
+    'bool': _bool,
+    'json': _json,
+    'tojson': _tojson,
+    'b64': _b64,
+    'join': _join,
+    'len': len,
+}
+# Bound callable of each chain compiled so far
+_chains = {}
+
+def register_modifier(name, func):
+    '''
+    Registers func as the !name. modifier. func is called with the value,
+    and with the argument as well for !name(argument).
+    '''
+    MODIFIERS[name] = func
+    _chains.clear()
+
+def _with_argument(func, argument):
+    return lambda value: func(value, argument)
+
+def _bind(steps):
+    funcs = []
+    for name, argument in steps:
+        func = MODIFIERS[name]
+        funcs.append(func if argument is None else _with_argument(func, argument))
+    if len(funcs) == 1:
+        return funcs[0]
+    def chain(value):
+        for func in funcs:
+            value = func(value)
+        return value
+    return chain
+
+def compile_modifiers(text):
+    '''
+    Splits the modifiers at the start of text from the rest of it. Returns
+    (modifier, rest), modifier applies every one of them in order and is
+    shared by all text with the same chain, None when text has none.
+        >>> compile_modifiers('!json.!len.Items')[1]
+        'Items'
+    '''
+    if not text.startswith('!'):
+        return None, text
+    steps = []
+    pos = 0
+    while True:
+        match = MODIFIER.match(text, pos)
+        if match is None or match.group(1) not in MODIFIERS:
+            break
+        steps.append(match.group(1, 2))
+        pos = match.end()
+    if not steps:
+        return None, text
+    steps = tuple(steps)
+    modifier = _chains.get(steps)
+    if modifier is None:
+        modifier = _chains[steps] = _bind(steps)
+    return modifier, text[pos:]
+
+####
+# Template compiler
+# Walks a structure once and builds a plan of every lookup, modifier and
+# random found in it. Static values (!random, !event., modifiers) are
+# resolved during the walk, action lookups (!Create[0]. etc) become slots
+# that are resolved once their command has run.
+######
+ACTION_LOOKUP = re.compile(r'^!(\w+\[\d+\])(?:\.(.*))?$', re.DOTALL)
+
+class Slot(object):
+    '''
+    A single templated value in the plan, where it lives and what it looks up
+    '''
+    __slots__ = ('container', 'key', 'path', 'source', 'lookup', 'modifier')
+
+    def __init__(self, container, key, path, source, lookup_path, modifier):
+        self.container = container
+        self.key = key
+        self.path = path
+        self.source = source
+        self.lookup = lookup_path
+        self.modifier = modifier
+
+    def evaluate(self, value):
+        found = lookup(value, self.lookup)
+        if self.modifier is not None:
+            return self.modifier(found)
+        return found
+
+class TemplatePlan(object):
+    '''
+    TemplatePlan is returned from compile_template. data is the templated
+    copy of the compiled structure, slots is an index of source -> [Slot].
+    Calling resolve with a source writes each of its slots into data once.
+    '''
+
+    def __init__(self, data):
+        self.data = data
+        self.slots = {}
+
+    def add(self, slot):
+        self.slots.setdefault(slot.source, []).append(slot)
+
+    def resolve(self, source, value):
+        for slot in self.slots.pop(source, ()):
+            slot.container[slot.key] = slot.evaluate(value)
+
+    def snapshot(self):
+        '''
+        Returns a copy of data that resolving slots does not change, taken
+        before any are resolved it still holds every lookup. Only the
+        containers along the way to a slot are copied, the rest is shared.
+        '''
+        root = dict(self.data) if isinstance(self.data, dict) else list(self.data)
+        copies = {id(self.data): root}
+        for slots in self.slots.values():
+            for slot in slots:
+                src, dst = self.data, root
+                for key in slot.path[:-1]:
+                    src = src[key]
+                    child = copies.get(id(src))
+                    if child is None:
+                        child = copies[id(src)] = dict(src) if isinstance(src, dict) else list(src)
+                        dst[key] = child
+                    dst = child
+        return root
+
+    def references(self, source):
+        '''
+        Returns the lookup paths of every pending slot waiting on source
+        '''
+        return [slot.lookup for slot in self.slots.get(source, ())]
+
+    def dependencies(self, path):
+        '''
+        Groups the sources of pending slots found under path by the key that
+        follows path, for a Commands list this is command index -> sources
+        '''
+        path = tuple(path)
+        depth = len(path)
+        found = {}
+        for source, slots in self.slots.items():
+            for slot in slots:
+                if len(slot.path) > depth and slot.path[:depth] == path:
+                    found.setdefault(slot.path[depth], set()).add(source)
+        return found
+
+def _static(value, event, prefix_event, prefix_random):
+    '''
+    Resolves the lookups that do not depend on a command in a single pass,
+    in the order template_event always applied them
+    '''
+    if value.startswith(prefix_random):
+        value = inject_rand(value, prefix_random)
+    elif value.startswith(prefix_event):
+        value = lookup(event, to_path(remove_prefix(value, prefix_event)))
+    if isinstance(value, str) and value.startswith('!'):
+        modifier, rest = compile_modifiers(value)
+        if modifier is not None:
+            # The rest can itself be an !event. or !random value, as in !int.!event.Count
+            if rest.startswith('!'):
+                rest = _static(rest, event, prefix_event, prefix_random)
+            value = modifier(rest)
+    return value
+
+def compile_template(obj, event=None, prefix_event='!event.', prefix_random='!random'):
+    '''
+    Compiles obj into a TemplatePlan in one walk of the structure.
+    event is the object !event. lookups are made against, defaults to obj.
+    '''
+    if event is None:
+        event = obj
+    root = [None]
+    plan = TemplatePlan(None)
+    stack = [([obj], root, ())]
+    while stack:
+        src, dst, path = stack.pop()
+        items = src.items() if isinstance(src, dict) else enumerate(src)
+        for k, v in items:
+            if isinstance(v, dict):
+                v, child = {}, v
+                stack.append((child, v, path + (k,)))
+            elif isinstance(v, list):
+                v, child = [None] * len(v), v
+                stack.append((child, v, path + (k,)))
+            elif isinstance(v, str) and v.startswith('!'):
+                v = _static(v, event, prefix_event, prefix_random)
+                match = ACTION_LOOKUP.match(v) if isinstance(v, str) else None
+                if match:
+                    modifier, rest = compile_modifiers(match.group(2) or '')
+                    plan.add(Slot(dst, k, path[1:] + (k,), match.group(1), to_path(rest), modifier))
+            dst[k] = v
+    plan.data = root[0]
+    return plan
@@ -1,20 +1,40 @@
 #!/usr/bin/env python3.6
 
-import argparse
-import boto3 
+# Imports are kept to what every invocation needs, boto3 is imported by the
+# client pool when the first session is built and argparse only by the CLI
 import json
-import urllib
-from cfnresponse import send, SUCCESS, FAILED
+import threading
+import time
+import checkpoint
+from batch import is_batch, run_batch
+from cfnresponse import send, SUCCESS, FAILED, TRUNCATE
+from checkpoint import Checkpoints
+from clients import client_pool
+from coalesce import coalesce
 from command import Command
-from helper import traverse_find, traverse_modify, to_path, json_serial, remove_prefix, inject_rand, return_modifier, convert
-from logger import logger
+from continuation import CONTINUATION_KEY, LambdaInvoker, LocalInvoker, Suspend, continuation_event, continuation_state
+import metrics
+from helper import compile_template, lookup, json_serial, prune, remove_prefix, serializable, to_bool
+from logger import logger, payload
+from retry import Deadline
+from scheduler import run_graph
+from validate import dry_run_report, validate_plan
 
 
 class test_context(dict):
     '''This is a text context object used when running function locally'''
-    def __init__(self,profile,region):
+    def __init__(self,profile,region,timeout=None):
         self.profile = profile
         self.region = region
+        self.timeout = timeout
+        self.invoked_function_arn = 'local'
+        if timeout:
+            # With a timeout the local run gets a deadline, and can suspend like lambda would
+            self.reset()
+            self.get_remaining_time_in_millis = lambda: max(self.end - time.time(),0) * 1000
+
+    def reset(self):
+        self.end = time.time() + self.timeout
 
 # Trims prefix
 def remove_prefix(text, prefix):
@@ -39,22 +59,115 @@ class CfnBotoInterface(object):
     prefix_event = '!event.'
     prefix_random = '!random'
     test = False
+    max_concurrency = 8
+    response_reserve = 5.0
+    suspended = False
+    # Used to re-invoke the function when suspending, LambdaInvoker if not set
+    invoker = None
+    # What to do when the response is over the CloudFormation limit, Truncate or Fail
+    oversize = TRUNCATE
+    # Whether CloudFormation accepted the response, None until one is sent
+    sent = None
+    # Command index to the coalesced call that serves it
+    coalesced = {}
+    # The status sent to CloudFormation, None until one is sent
+    status = None
+    # Checks commands against the botocore service models before running them
+    check_models = True
+    # Reports the plan instead of running it
+    dry_run = False
+    errors = []
+    report = None
+    # Where progress is saved after each command, checkpoint.store if not set
+    checkpoint_store = None
+    checkpoints = None
 
 
     # Initializes the object
     def __init__(self,event,context):
-        logger.debug("Event Received: {}".format(event))
+        logger.debug("Event Received: %s", payload(event))
         self.raw_data = event
         self.context = context
-        self.template_event()
-        self.set_attributes_from_data()
-        self.setup_session()
+        # Response of each command by its place holder, kept apart from the ResponseData in
+        # the plan so the templated data saved with the progress never holds a response
+        self.results = {}
+        # Progress saved by an earlier invocation that suspended, None on a new event
+        self.continuation = event.get(CONTINUATION_KEY, None)
+        # Progress saved after each command, an event delivered again resumes from it. It is
+        # never older than a carried continuation, which lambda delivers again on a failed attempt
+        self.progress_lock = threading.RLock()
+        self.checkpoints = self._checkpoints(event)
+        if self.checkpoints is not None:
+            saved = self.checkpoints.load()
+            if saved:
+                logger.info("Resuming %s from its checkpoint", event['RequestId'])
+                self.continuation = saved
+        # Keeps response_reserve seconds of the invocation back to send the response
+        self.deadline = Deadline(context,self.response_reserve)
+        phases = [
+            ('template_event',self.template_event),
+            ('set_attributes',self.set_attributes_from_data),
+            ('setup_session',self.setup_session),
+            ('validate',self.validate),
+            ('run_commands',self.run_action),
+        ]
+        for name,phase in phases:
+            # A phase that fails sends FAILED, the phases after it are not run
+            if self.status is not None:
+                break
+            with metrics.span(name):
+                phase()
+        if self.status is None and not self.suspended and not self.dry_run:
+            self._send_status(SUCCESS)
+
+    def command_action(self):
+        '''
+        Returns the ActionObject whose Commands run, Update with Replace runs Create
+        '''
         if self.action == 'Update' and bool(self.action_obj.get('Replace',False)):
+            return 'Create'
+        return self.action
+
+    def validate(self):
+        '''
+        Validates the whole ActionObject before any command runs, so a mistake
+        in the last command fails the resource before the first creates anything
+        '''
+        if self.continuation:
+            # Validated by the invocation that suspended
+            return
+        try:
+            self.errors = validate_plan(self.plan,self.command_action(),self.action,self.check_models)
+        except Exception as e:
+            self.errors = ["Unable to validate: {}".format(e)]
+        if self.errors and not self.dry_run:
+            self.reason = "Validation Failed: {}".format('; '.join(self.errors))
+            logger.error(self.reason)
+            self._send_status(FAILED)
+
+    def run_action(self):
+        action = self.command_action()
+        if action != self.action:
             logger.info('Replacement specified, running Create')
-            self.run_commands('Create')
+        if self.dry_run:
+            self.dry_run_commands(action)
         else:
-            self.run_commands(self.action)
-        self._send_status(SUCCESS)
+            self.run_commands(action)
+
+    def dry_run_commands(self,action):
+        '''
+        Reports the commands that would run, what each waits on and the API
+        calls they would make, without calling AWS
+        '''
+        self.completed = set()
+        self.waiting = {}
+        dependencies = {}
+        try:
+            action_obj = self.data['ResourceProperties'].get(action,{})
+            dependencies,_ = self._schedule(action,action_obj,action_obj.get('Commands',[]))
+        except Exception as e:
+            self.errors = self.errors + ["Scheduling Failed: {}".format(e)]
+        self.report = dry_run_report(self.plan,action,self.action,dependencies,self.coalesced,self.errors)
 
     def template_event(self):
         '''
@@ -63,13 +176,19 @@ class CfnBotoInterface(object):
         Finds and replaces Event requests 
         '''
         try:
-            # This is a set of calls to helper functions which templates out the arguments
-            logger.info("Raw Event: {}".format(self.raw_data))
-            self.data = traverse_find(self.raw_data,self.prefix_random,self._interpolate_rand)
-            self.data = traverse_find(self.data,self.prefix_event,self._template)
-            for modifier in [ '!str.', '!int.' ]:
-                self.data = traverse_find(self.data,modifier,self._mod)
-            logger.info("Templated Event: {}".format(self.data))
+            # Compiles the event once, static lookups are resolved now and
+            # command lookups are left as slots in the plan for run_commands
+            logger.info("Raw Event: %s", payload(self.raw_data))
+            if self.continuation:
+                # The saved data is already templated, only the lookups still waiting on a command are left
+                self.plan = compile_template(self.continuation['Data'],event=self.raw_data,prefix_event=self.prefix_event,prefix_random=self.prefix_random)
+            else:
+                self.plan = compile_template(self.raw_data,prefix_event=self.prefix_event,prefix_random=self.prefix_random)
+            self.data = self.plan.data
+            # Lookups resolve in place in data, progress is saved with them unresolved
+            # so a resumed invocation resolves them again, PhysicalResourceId included
+            self.templated = self.plan.snapshot()
+            logger.info("Templated Event: %s", payload(self.data))
         except Exception as e:
             # If user did not pass the correct properties, return failed with error.
             self.reason = "Templating Event Data Failed: {}".format(e)
@@ -84,13 +203,14 @@ class CfnBotoInterface(object):
         try:
             # Setup local Vars
             self.action = self.data['RequestType']
-            logger.info("Action: {}".format(self.action))
+            logger.info("Action: %s", self.action)
             self.action_obj = self.data['ResourceProperties'].get(self.action,{})
             self.old_physical_resource_id = self.data.get('PhysicalResourceId', 'None')
             self.physical_resource_id = self.action_obj.get('PhysicalResourceId', self.old_physical_resource_id)
-            logger.info("Physical Resource Id: {}".format(self.physical_resource_id))
+            logger.info("Physical Resource Id: %s", self.physical_resource_id)
             self.response_data = self.action_obj.get('ResponseData', {})
-            logger.info("Response Data: {}".format(self.response_data))
+            self.oversize = self.action_obj.get('OversizeResponse', TRUNCATE)
+            logger.info("Response Data: %s", payload(self.response_data))
         except Exception as e:
             # If user did not pass the correct properties, return failed with error.
             self.reason = "Missing required property: {}".format(e)
@@ -103,18 +223,19 @@ class CfnBotoInterface(object):
         Checks to see if running locally by use of test_context
         If so use profile and region from test_context
         If not let use default session
+        Sessions are cached in the client pool across invocations
         '''
         try:
             if isinstance(self.context,test_context):
                 # For testing use profile and region from test_context
                 logger.debug('Using test_context')
-                logger.debug("Profile: {}".format(self.context.profile))
-                logger.debug("Region: {}".format(self.context.region))
+                logger.debug("Profile: %s", self.context.profile)
+                logger.debug("Region: %s", self.context.region)
                 self.test = True
-                self.session = boto3.session.Session(profile_name=self.context.profile,region_name=self.context.region)
+                self.session = client_pool.session(profile=self.context.profile,region=self.context.region)
             else:
-                # Sets up the session in lambda context
-                self.session = boto3.session.Session()
+                # Sets up the session in lambda context, reused while the container is warm
+                self.session = client_pool.session()
         except Exception as e:
             # Client failed
             self.reason = "Setup Session Failed: {}".format(e)
@@ -124,32 +245,29 @@ class CfnBotoInterface(object):
 
     def run_commands(self,action):
         '''
-        Loops over the Commands array, init a Command obj, and run
-        After each command run, it will find and replace any tempalte looking for 
+        Runs the Commands array, init a Command obj for each, and run
+        Commands that look up the output of an earlier command wait for it,
+        commands that do not run concurrently, unless Serial is set
+        After each command run, the plan fills any template looking for 
         that commands output values 
         '''
         try:
-            logger.info("Running Commands for {}".format(action))
+            logger.info("Running Commands for %s", action)
             action_obj = self.data['ResourceProperties'].get(action,{})
             commands = action_obj.get('Commands', None)
-            logger.info("Commands: {}".format(commands))
-            # This is the main call it calls the methods, on the client, with the arguments
-            count = 0
-            while count < len(commands):
-                # Use Command class to validate the command and run it
-                command = Command(self.session,commands[count])
-                response = command.run()
-                # place_holder creates a key to hold the response in the response_data dict
-                place_holder = "{}[{}]".format(self.action,count)
-                # response_data only takes json serializable data, json_serial function switches types!
-                self.response_data[place_holder] = json.loads(json.dumps(response,default=json_serial))
-                logger.debug("Response: {}".format(self.response_data))
-                # This set traverses the commands looking for the place_holder and replaces it with the value 
-                self.current_var_fetch = place_holder
-                commands = traverse_find(commands,"!{}".format(self.current_var_fetch),self._variable_fetch)
-                self.response_data = traverse_find(self.response_data,"!{}".format(self.current_var_fetch),self._variable_fetch)
-                logger.debug("Templated Command Set: {}".format(commands))
-                count = count + 1
+            logger.info("Commands: %s", payload(commands))
+            self.completed = set()
+            self.waiting = {}
+            if self.continuation:
+                self._restore(commands)
+            dependencies,max_concurrency = self._schedule(action,action_obj,commands)
+            self.suspending = {}
+            run_graph(lambda count: self._run_command(commands,count),dependencies,max_concurrency,self.deadline)
+            logger.info("Client Pool: %s", client_pool.stats())
+        except Suspend as e:
+            # A command is still waiting and time is short, save progress and carry on in a new invocation
+            logger.info("%s", e)
+            self._suspend()
         except Exception as e:
             # Commands failed 
             self.reason = "Commands Failed: {}".format(e)
@@ -157,82 +275,300 @@ class CfnBotoInterface(object):
             self._send_status(FAILED)
             return
 
-    def _set_buffer(self, value):
+    def _schedule(self,action,action_obj,commands):
         '''
-        Sets a buffer to be used later 
+        Returns what each command waits on and how many commands run at once,
+        and coalesces the commands that can share a call
         '''
-        self.buff = value
+        serial = to_bool(action_obj.get('Serial', False))
+        if serial:
+            # Serial runs each command in order, for commands with ordering the lookups do not show
+            dependencies = dict((count,set([count - 1]) if count else set()) for count in range(len(commands)))
+            max_concurrency = 1
+        else:
+            dependencies = self._dependencies(action,commands)
+            max_concurrency = int(action_obj.get('MaxConcurrency', self.max_concurrency))
+        # Commands finished by an earlier invocation are not run again
+        dependencies = dict((count,deps - self.completed) for count,deps in dependencies.items() if count not in self.completed)
+        logger.info("Command Dependencies: %s", payload(dependencies))
+        if not serial and to_bool(action_obj.get('Coalesce', True)):
+            # Commands with nothing to wait on calling the same batchable method share one call
+            ready = [count for count,deps in dependencies.items() if not deps and count not in self.waiting]
+            self.coalesced = coalesce(self.session,commands,ready)
+        return dependencies,max_concurrency
 
-    def _template(self, value):
+    def _run_command(self,commands,count):
         '''
-        Used in a traverse function to find and modify based on a prefix
+        Validates and runs a single command, then fills the slots waiting on it
         '''
-        value = remove_prefix(value,self.prefix_event)
-        traverse_modify(self.raw_data,value,self._set_buffer)
-        return self.buff
+        command = Command(self.session,commands[count])
+        with metrics.span('command',Service=command.service,Method=command.method) as span:
+            span.set('Index',count)
+            self._run_and_resolve(command,count)
+        with self.progress_lock:
+            if self._settled():
+                return
+            self.completed.add(count)
+        self._checkpoint()
 
-    def _variable_fetch(self, value):
+    def _settled(self):
         '''
-        Used in a traverse function to find and modify based on a prefix or modifier
+        Returns True once the response is sent or the commands are abandoned,
+        a command still running after that must not change the data or the
+        checkpoint, which is deleted once the response is sent
         '''
-        value = remove_prefix(value,"!{}.".format(self.current_var_fetch))
-        mod, value = return_modifier(value)
-        logger.info("Modifier: {}".format(mod))
-        traverse_modify(self.response_data[self.current_var_fetch],value,self._set_buffer)
-        if mod:
-            return convert(self.buff,mod)
-        return self.buff
+        return self.status is not None or self.deadline.abandoned
 
-    def _mod(self, value):
-        mod, value = return_modifier(value)
-        if mod:
-            return convert(value,mod)
-        return value
-         
-    def _interpolate_rand(self, value):
+    def _checkpoints(self,event):
         '''
-        Drops in a random number where !rand is found
+        Returns the Checkpoints of this request, None when there is no store
+        or the event has no RequestId to key them by
+        '''
+        store = self.checkpoint_store or checkpoint.store
+        if store is None or self.dry_run or not event.get('RequestId', None):
+            return None
+        return Checkpoints(store,event['RequestId'])
+
+    def _checkpoint(self):
+        '''
+        Saves the responses of the commands run so far, and the ones still waiting
+        '''
+        if self.checkpoints is None:
+            return
+        with self.progress_lock:
+            if self._settled():
+                return
+            waiting = dict((count,attempts) for count,attempts in self.waiting.items() if count not in self.completed)
+            responses = dict(
+                ("{}[{}]".format(self.action,count),self.results["{}[{}]".format(self.action,count)])
+                for count in self.completed | set(waiting)
+            )
+            state = continuation_state(self.templated,responses,waiting)
+            sequence = self.checkpoints.sequence()
+        # Saved outside the lock so other commands carry on during the write, the
+        # sequence drops this state if a newer one is saved first
+        self.checkpoints.save(state,sequence)
+
+    def _run_and_resolve(self,command,count):
+        # place_holder creates a key to hold the response in the results dict
+        place_holder = "{}[{}]".format(self.action,count)
+        if count not in self.waiting:
+            # This is the main call it calls the method, on the client, with the arguments
+            if count in self.coalesced:
+                response = self.coalesced[count].response(count,command,self.deadline)
+            else:
+                response = command.run(self.deadline)
+            with metrics.span('resolve'):
+                # Only the fields that later lookups reference are kept, and only those are
+                # made json serializable, a streaming body kept is read with the command's Stream
+                pruned = serializable(prune(response,self.plan.references(place_holder)),command.stream)
+            with self.progress_lock:
+                if self._settled():
+                    return
+                self.results[place_holder] = pruned
+                if command.wait_options:
+                    # Saved as waiting, so a retry resumes the wait rather than repeating the call
+                    self.waiting[count] = 0
+            logger.debug("Response: %s", payload(self.results[place_holder]))
+            if command.wait_options:
+                self._checkpoint()
+        if command.wait_options:
+            try:
+                command.wait(self.deadline,self.waiting.get(count,0))
+            except Suspend as e:
+                self.suspending[count] = e.attempts
+                raise
+        with metrics.span('resolve'), self.progress_lock:
+            if self._settled():
+                return
+            # Fills every slot in the plan waiting on this command, this includes the
+            # commands yet to run and the response data since both live in the plan
+            self.plan.resolve(place_holder,self.results[place_holder])
+
+    def _restore(self,commands):
         '''
-        withrand = inject_rand(value,self.prefix_random)
-        logger.info("WithRand returned: {}".format(withrand))
-        return withrand
-                
+        Restores the results of the commands an earlier invocation finished,
+        and the wait attempts of the ones it suspended
+        '''
+        for count in range(len(commands)):
+            place_holder = "{}[{}]".format(self.action,count)
+            if place_holder in self.continuation['Responses']:
+                self.results[place_holder] = self.continuation['Responses'][place_holder]
+                if str(count) in self.continuation['Waiting']:
+                    self.waiting[count] = self.continuation['Waiting'][str(count)]
+                else:
+                    self.plan.resolve(place_holder,self.results[place_holder])
+                    self.completed.add(count)
+        logger.info("Restored Commands: %s Waiting: %s", sorted(self.completed), self.waiting)
+
+    def _suspend(self):
+        '''
+        Re-invokes the function with the progress made so far
+        '''
+        responses = dict(
+            ("{}[{}]".format(self.action,count),self.results["{}[{}]".format(self.action,count)])
+            for count in self.completed | set(self.suspending)
+        )
+        try:
+            event = continuation_event(self.raw_data,self.templated,responses,self.suspending)
+            if self.checkpoints is not None:
+                # With the wait attempts made so far, which the checkpoints after each command do not have
+                self.checkpoints.save(event[CONTINUATION_KEY])
+            invoker = self.invoker or LambdaInvoker(self.session)
+            invoker.invoke(self.context,event)
+        except Exception as e:
+            # Nothing carries on the commands, so CloudFormation is told now rather than at its timeout
+            self.reason = "Unable to Suspend: {}".format(e)
+            logger.error(self.reason)
+            self._send_status(FAILED)
+            return
+        self.suspended = True
+
+    def _dependencies(self,action,commands):
+        '''
+        Maps each command index to the earlier commands it looks up
+        '''
+        sources = self.plan.dependencies(('ResourceProperties',action,'Commands'))
+        place_holders = dict(("{}[{}]".format(self.action,count),count) for count in range(len(commands)))
+        dependencies = {}
+        for count in range(len(commands)):
+            # Only earlier commands count, a lookup of a later command was never resolved in time
+            dependencies[count] = set(
+                place_holders[source] for source in sources.get(count,())
+                if place_holders.get(source,count) < count
+            )
+        return dependencies
+
     def _send_status(self, PASS_OR_FAIL):
         '''
         Sends a Pass or Fail to CloudFormation, uses object attuibutes as response data
         '''
+        with self.progress_lock:
+            # Commands still running stop saving progress from here on
+            self.status = PASS_OR_FAIL
+        if self.dry_run:
+            # Nothing is sent on a dry run, the failure is reported with the plan
+            if self.reason:
+                self.errors = self.errors + [self.reason]
+            return
+        if isinstance(self.response_data,dict):
+            # The commands' responses are sent along with the ResponseData
+            self.response_data = dict(self.response_data)
+            self.response_data.update(self.results)
         if self.physical_resource_id:
             logger.info('there is phsy id')
-            traverse_modify(self.response_data,to_path(remove_prefix(self.physical_resource_id,'!')),self._set_buffer)
+            self.buff = lookup(self.response_data,remove_prefix(self.physical_resource_id,'!'))
         else: 
             self.buff = str('None')
-        logger.info("Physical Resource Id After Find: {}".format(self.buff))
+        logger.info("Physical Resource Id After Find: %s", self.buff)
         #self.response_data = urllib.parse.urlencode(self.response_data).encode('ascii')
         if not self.test:
-            send(
-                self.raw_data,
-                self.context,
-                PASS_OR_FAIL,
-                physical_resource_id=self.buff,
-                reason=self.reason,
-                response_data=self.response_data
-            )
+            with metrics.span('send',Status=PASS_OR_FAIL):
+                self.sent = send(
+                    self.raw_data,
+                    self.context,
+                    PASS_OR_FAIL,
+                    physical_resource_id=self.buff,
+                    reason=self.reason,
+                    response_data=self.response_data,
+                    oversize=self.oversize
+                )
         else:
-            logger.info("Context Type: {}: ".format(json.dumps(self.context)))
-            logger.info("PASS/FAIL Type: {}: ".format(json.dumps(PASS_OR_FAIL)))
-            logger.info("Physical Resource Id Type: {}: ".format(json.dumps(self.buff)))
-            logger.info("Response Data Type: {}: ".format(json.dumps(self.response_data)))
+            logger.info("Context Type: %s: ", json.dumps(self.context))
+            logger.info("PASS/FAIL Type: %s: ", json.dumps(PASS_OR_FAIL))
+            logger.info("Physical Resource Id Type: %s: ", json.dumps(self.buff))
+            logger.info("Response Data Type: %s: ", json.dumps(self.response_data))
+        if self.checkpoints is not None and self.sent is not False:
+            # The request is answered, a retry of it has nothing to resume
+            self.checkpoints.delete()
 
 
-def lambda_handler(event, context):
+def handle_event(event, context):
+    '''
+    Handles one CloudFormation event, returns False if its response was not delivered
+    '''
     boto_proxy = CfnBotoInterface(event,context)
+    return boto_proxy.sent is not False
+
+def lambda_handler(event, context):
+    '''
+    Handles a CloudFormation event, or a batch of them wrapped in SQS or SNS Records.
+    For a batch the records whose response was not delivered are returned in
+    batchItemFailures, sessions and clients are shared by the whole batch.
+    '''
+    metrics.collector.reset()
+    try:
+        if is_batch(event):
+            return run_batch(event, context, handle_event)
+        handle_event(event, context)
+    finally:
+        metrics.flush()
+
+# Run in a fresh interpreter by profile_startup, so imports are measured from cold
+STARTUP_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import lambda_function
+imported = time.perf_counter()
+sys.stderr.write('startup-probe: first invocation\\n')
+options = json.load(sys.stdin)
+context = lambda_function.test_context(options['profile'], options['region'])
+# Templates, validates and plans the event, but makes no API calls that could change resources
+lambda_function.CfnBotoInterface.dry_run = True
+lambda_function.lambda_handler(options['event'], context)
+invoked = time.perf_counter()
+sys.stderr.write('startup-probe: ' + json.dumps({'import': imported - start, 'first_invocation': invoked - imported}) + '\\n')
+"""
+
+def profile_startup(event, profile, region, top=15):
+    '''
+    Reports the time to import lambda_function from cold, and the cost of the
+    first invocation, broken down by the modules each one imports. The first
+    invocation is a dry run, it builds sessions and clients but calls no AWS API.
+    The breakdown needs python 3.7 or later for -X importtime.
+    '''
+    import os
+    import subprocess
+    import sys
+    from collections import OrderedDict
+    options = json.dumps({'event': event, 'profile': profile, 'region': region}, default=json_serial)
+    probe = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', STARTUP_PROBE],
+        input=options.encode('utf-8'), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    report = {'import': {'modules': []}, 'first_invocation': {'modules': []}}
+    phase = 'import'
+    for line in probe.stderr.decode('utf-8').splitlines():
+        if line.startswith('startup-probe: first invocation'):
+            phase = 'first_invocation'
+        elif line.startswith('startup-probe: '):
+            for key, seconds in json.loads(line[len('startup-probe: '):]).items():
+                report[key]['seconds'] = seconds
+        elif line.startswith('import time:') and '|' in line:
+            # import time: self [us] | cumulative | imported package
+            own, cumulative, name = line[len('import time:'):].split('|')
+            # Nested imports are indented two spaces a level, lambda_function's own imports are one level in
+            if own.strip().isdigit() and not name.startswith('    '):
+                report[phase]['modules'].append((name.strip(), int(cumulative) / 1e6))
+    for phase in report.values():
+        modules = sorted(phase['modules'], key=lambda module: module[1], reverse=True)[:top]
+        phase['modules'] = OrderedDict(modules)
+    if probe.returncode != 0:
+        report['error'] = probe.stderr.decode('utf-8').strip().splitlines()[-1:]
+    return report
+
 
 if __name__ == "__main__":
+    import argparse
     parser = argparse.ArgumentParser(description='Lambda Function to provide pass through interface to CloudFormation.')
     parser.add_argument("-r","--region", help="Region in which to run.", default='us-east-1')
     parser.add_argument("-p","--profile", help="Profile name to use when connecting to aws.", default=None)
     parser.add_argument("-m","--method_override", help="Method Type Override.", default=None, choices=[None,'Create','Update','Delete'])
-    parser.add_argument("-e","--event", help="Event object passed from CFN.", default={
+    parser.add_argument("-t","--timeout", help="Seconds the local run has before it suspends, like a lambda timeout.", type=float, default=None)
+    parser.add_argument("-d","--dry-run", help="Validate the event and print the plan of commands it would run, without calling AWS.", action='store_true')
+    parser.add_argument("-P","--profile-startup", help="Report import and first invocation time by module, instead of a normal run.", action='store_true')
+    parser.add_argument("-e","--event", help="Event object passed from CFN, as JSON.", type=json.loads, default={
         'RequestType': 'Delete', 
         'ResourceProperties': { 
             'Create': {
@@ -299,7 +635,7 @@ if __name__ == "__main__":
                  {'Method': '!event.OldResourceProperties.Value'}
             ],
             'OtherRand': [ 
-                 {'!random.OldResourceProperties.Value-!random.something'}
+                 '!random.OldResourceProperties.Value-!random.something'
             ]
         }
     })
@@ -308,6 +644,21 @@ if __name__ == "__main__":
     if args.method_override:
         args.event['RequestType'] = args.method_override
     
-    context = test_context(args.profile,args.region)
+    if args.profile_startup:
+        print(json.dumps(profile_startup(args.event,args.profile,args.region),indent=2))
+        raise SystemExit(0)
+
+    context = test_context(args.profile,args.region,args.timeout)
+    if args.dry_run:
+        CfnBotoInterface.dry_run = True
+        boto_proxy = CfnBotoInterface(args.event,context)
+        # A phase that failed before the plan was built only has its errors to report
+        report = boto_proxy.report or {'Errors': boto_proxy.errors}
+        print(json.dumps(report,indent=2,default=json_serial))
+        # Fails on an invalid event, or one that could not be planned at all
+        raise SystemExit(1 if report['Errors'] else 0)
+    # Continuations run in process once the first invocation returns
+    CfnBotoInterface.invoker = LocalInvoker(lambda_handler)
     lambda_handler(args.event, context)
+    CfnBotoInterface.invoker.drain()
 
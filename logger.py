@@ -1,11 +1,63 @@
 import logging
+import os
+import reprlib
 
 # Setup logger
 logger = logging.getLogger('CfnBotoInterface')
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
 console_logger = logging.StreamHandler()
-console_logger.setLevel(logging.INFO)
+console_logger.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 console_logger.setFormatter(formatter)
 logger.addHandler(console_logger)
 
+# Most characters of a payload written to the log
+PAYLOAD_LIMIT = int(os.environ.get('LOG_PAYLOAD_LIMIT', 2048))
+
+
+# Containers reprlib writes out of their items, only the items count against the limit
+CONTAINERS = (dict, list, tuple, set, frozenset)
+
+
+class _Repr(reprlib.Repr):
+    '''
+    Repr that stops writing items once limit characters are written, so a
+    large payload is never formatted in full just to be cut down
+    '''
+    def __init__(self, limit):
+        reprlib.Repr.__init__(self)
+        self.maxlevel = 10
+        self.maxdict = self.maxlist = self.maxtuple = self.maxset = self.maxfrozenset = 100
+        self.maxstring = self.maxother = self.maxlong = limit
+        self.left = limit
+
+    def repr1(self, x, level):
+        if self.left <= 0:
+            return '...'
+        text = reprlib.Repr.repr1(self, x, level)
+        if not isinstance(x, CONTAINERS):
+            self.left -= len(text)
+        return text
+
+
+class payload(object):
+    '''
+    Wraps an event, response or other large object passed to the logger as an
+    argument. It is only turned into text if the record is emitted, and then
+    only up to about limit characters.
+        logger.debug("Response: %s", payload(response))
+    '''
+    __slots__ = ('obj', 'limit')
+
+    def __init__(self, obj, limit=None):
+        self.obj = obj
+        self.limit = PAYLOAD_LIMIT if limit is None else limit
+
+    def __str__(self):
+        if isinstance(self.obj, str):
+            text = self.obj[:self.limit + 1]
+        else:
+            text = _Repr(self.limit).repr(self.obj)
+        if len(text) > self.limit:
+            return "{}... (cut at {} characters)".format(text[:self.limit], self.limit)
+        return text
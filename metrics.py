@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+import time
+
+# Spans are only timed when enabled, and only written to the log as
+# CloudWatch Embedded Metric Format when emf is also set
+enabled = os.environ.get('METRICS_ENABLED', 'false').lower() in ('true', '1', 'yes')
+emf = enabled and os.environ.get('METRICS_EMF', 'true').lower() in ('true', '1', 'yes')
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'CfnBotoInterface')
+
+
+class Collector(object):
+    '''
+    Collector keeps the spans timed in this process, for flush to write out
+    and for tests and benchmarks to read back
+    '''
+    def __init__(self):
+        self.records = []
+        self.flushed = 0
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, dimensions, properties):
+        with self.lock:
+            self.records.append((name, seconds, dimensions, properties))
+
+    def totals(self, name=None):
+        '''
+        Sums seconds by phase, or by the given dimension of the spans named name
+        '''
+        totals = {}
+        for record_name, seconds, dimensions, _ in self.records:
+            if name is None:
+                key = record_name
+            elif record_name == name:
+                key = tuple(sorted(dimensions.items()))
+            else:
+                continue
+            totals[key] = totals.get(key, 0.0) + seconds
+        return totals
+
+    def reset(self):
+        with self.lock:
+            self.records = []
+            self.flushed = 0
+
+collector = Collector()
+
+
+class Span(object):
+    '''
+    Times the block it wraps and records it in the collector under name,
+    set adds properties such as the attempt count once they are known
+    '''
+    __slots__ = ('name', 'dimensions', 'properties', 'start')
+
+    def __init__(self, name, dimensions):
+        self.name = name
+        self.dimensions = dimensions
+        self.properties = {}
+
+    def set(self, key, value):
+        self.properties[key] = value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.properties['Error'] = exc_type.__name__
+        collector.record(self.name, time.perf_counter() - self.start, self.dimensions, self.properties)
+        return False
+
+class NoSpan(object):
+    '''
+    Stands in for Span while metrics are disabled, it does nothing
+    '''
+    __slots__ = ()
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NO_SPAN = NoSpan()
+
+def span(name, **dimensions):
+    if not enabled:
+        return NO_SPAN
+    return Span(name, dimensions)
+
+
+def flush():
+    '''
+    Writes the spans recorded since the last flush to stdout as
+    Embedded Metric Format, one line each
+    '''
+    if not enabled:
+        return
+    with collector.lock:
+        records = collector.records[collector.flushed:]
+        collector.flushed = len(collector.records)
+    if not emf:
+        return
+    timestamp = int(time.time() * 1000)
+    for name, seconds, dimensions, properties in records:
+        line = dict(properties)
+        line.update(dimensions)
+        line['Phase'] = name
+        line['Duration'] = seconds * 1000
+        line['_aws'] = {
+            'Timestamp': timestamp,
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['Phase'] + sorted(dimensions)],
+                'Metrics': [{'Name': 'Duration', 'Unit': 'Milliseconds'}]
+            }]
+        }
+        print(json.dumps(line))
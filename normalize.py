@@ -0,0 +1,190 @@
+import base64
+import hashlib
+import json
+import os
+from datetime import date, datetime
+from decimal import Decimal
+
+# Most bytes of a streaming body read as Text or Json, Hash and Length read any size
+STREAM_MAX_BYTES = int(os.environ.get('STREAM_MAX_BYTES', str(1024 * 1024)))
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_AS = ('Text', 'Json', 'Hash', 'Length')
+
+# Types json encodes as they are, containers included since traverse hands them over too
+PASS_TYPES = frozenset([str, int, float, bool, type(None), dict, list])
+
+
+def stream_options(stream):
+    '''
+    Stream can be one of STREAM_AS, or a dict of As and MaxBytes
+    '''
+    if isinstance(stream, dict):
+        return stream
+    if stream:
+        return {'As': stream}
+    return None
+
+
+def _text(data):
+    # Bytes that are not utf-8 are passed on as base64, so binary survives the json response
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return base64.b64encode(data).decode('ascii')
+
+
+def read_stream(body, stream=None):
+    '''
+    Reads a streaming body, like the Body of s3.get_object or the Payload of
+    lambda.invoke, in chunks and returns it As Text, parsed Json, the sha256
+    Hash or the Length of its bytes. Text and Json fail past MaxBytes, Hash
+    and Length only hold a chunk at a time. The body is closed once read.
+    '''
+    stream = stream or {}
+    kind = stream.get('As', 'Text')
+    max_bytes = int(stream.get('MaxBytes', STREAM_MAX_BYTES))
+    digest = hashlib.sha256() if kind == 'Hash' else None
+    keep = kind in ('Text', 'Json')
+    chunks = []
+    length = 0
+    try:
+        while True:
+            chunk = body.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            length += len(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            elif keep:
+                if length > max_bytes:
+                    raise ValueError("Streaming body is larger than MaxBytes {}, read it As Hash or Length instead".format(max_bytes))
+                chunks.append(chunk)
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+    if kind == 'Length':
+        return length
+    if kind == 'Hash':
+        return digest.hexdigest()
+    data = b''.join(chunks)
+    if kind == 'Json':
+        return json.loads(data.decode('utf-8'))
+    return _text(data)
+
+
+def read_streams(response, stream=None):
+    '''
+    Reads the streaming members of a response, botocore only returns them at
+    the top level. Returns the response itself when it has none.
+    '''
+    if not isinstance(response, dict):
+        return response
+    read = None
+    for key, value in response.items():
+        if handler(type(value)) is _stream:
+            if read is None:
+                read = dict(response)
+            read[key] = read_stream(value, stream)
+    return response if read is None else read
+
+
+####
+# Type handlers
+# Each value json can not encode is converted by the handler of its type,
+# found with one dict lookup rather than a chain of isinstance checks.
+######
+def _decimal(value, stream):
+    # DynamoDB returns every number as a Decimal, whole ones stay ints
+    if not value.is_finite():
+        return str(value)
+    whole = int(value)
+    if whole == value:
+        return whole
+    return float(value)
+
+
+def _bytes(value, stream):
+    return _text(bytes(value))
+
+
+def _set(value, stream):
+    items = [normalize_value(item, stream) for item in value]
+    try:
+        items.sort()
+    except TypeError:
+        pass
+    return items
+
+
+def _isoformat(value, stream):
+    return value.isoformat()
+
+
+def _stream(value, stream):
+    return read_stream(value, stream)
+
+
+def _same(value, stream):
+    return value
+
+
+HANDLERS = {
+    Decimal: _decimal,
+    bytes: _bytes,
+    bytearray: _bytes,
+    set: _set,
+    frozenset: _set,
+    datetime: _isoformat,
+    date: _isoformat,
+}
+
+# Handler of every type seen so far, including subclasses and types with none
+_resolved = dict(HANDLERS)
+
+
+def register(cls, handler):
+    '''
+    Registers handler(value, stream) to convert values of type cls
+    '''
+    HANDLERS[cls] = handler
+    _resolved.clear()
+    _resolved.update(HANDLERS)
+
+
+def handler(cls):
+    '''
+    Returns the handler for values of type cls, None when it has none.
+    A subclass uses its nearest registered base, and a type with a read
+    method is a stream. Worked out once per type.
+    '''
+    try:
+        return _resolved[cls]
+    except KeyError:
+        pass
+    found = None
+    for base in cls.__mro__:
+        if base in HANDLERS:
+            found = HANDLERS[base]
+            break
+        if base in PASS_TYPES:
+            found = _same
+            break
+    else:
+        if callable(getattr(cls, 'read', None)):
+            found = _stream
+    _resolved[cls] = found
+    return found
+
+
+def normalize_value(value, stream=None):
+    '''
+    Returns value in a form json can encode, raises TypeError when it has no handler
+    '''
+    cls = type(value)
+    if cls in PASS_TYPES:
+        return value
+    convert = handler(cls)
+    if convert is None:
+        raise TypeError("Type %s not serializable" % cls)
+    return convert(value, stream)
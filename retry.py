@@ -0,0 +1,217 @@
+import random
+import threading
+import time
+from logger import logger
+
+# botocore error codes worth retrying, throttling codes also slow the service's token bucket
+THROTTLING_CODES = set([
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'TransactionInProgressException',
+    'RequestLimitExceeded', 'BandwidthLimitExceeded', 'LimitExceededException', 'RequestThrottled',
+    'SlowDown', 'PriorRequestNotComplete', 'EC2ThrottledException'
+])
+TRANSIENT_CODES = set(['RequestTimeout', 'RequestTimeoutException'])
+TRANSIENT_STATUS = set([500, 502, 503, 504])
+
+THROTTLED = 'throttled'
+TRANSIENT = 'transient'
+
+
+class Clock(object):
+    '''
+    Wall clock used for backoff and deadlines
+    '''
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+# Module level clock, tests swap in a fake one here
+default_clock = Clock()
+
+
+# Most of the invocation the reserve can take, so a short timeout still leaves time to run commands
+RESERVE_FRACTION = 0.2
+
+
+class Deadline(object):
+    '''
+    Deadline tracks the time left in the lambda invocation, keeping reserve
+    seconds back so there is always time to send the response to CloudFormation.
+    The reserve is at most RESERVE_FRACTION of the time left, a 3 second
+    timeout keeps 0.6 seconds back rather than leaving none for the commands.
+    Contexts without get_remaining_time_in_millis, like test_context, never run out.
+    Once abandoned, commands still running start no more API calls.
+    '''
+    def __init__(self, context, reserve=5.0, clock=None):
+        self.clock = clock or default_clock
+        self.abandoned = False
+        remaining = getattr(context, 'get_remaining_time_in_millis', None)
+        if remaining is None:
+            self.reserve = reserve
+            self.end = None
+        else:
+            remaining = remaining() / 1000.0
+            self.reserve = min(reserve, remaining * RESERVE_FRACTION)
+            self.end = self.clock.time() + remaining - self.reserve
+
+    def remaining(self):
+        if self.abandoned:
+            return 0.0
+        if self.end is None:
+            return float('inf')
+        return max(self.end - self.clock.time(), 0.0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def abandon(self):
+        self.abandoned = True
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def classify(error):
+    '''
+    Returns THROTTLED, TRANSIENT or None for an exception raised by a boto3 call
+    '''
+    from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        if code in THROTTLING_CODES:
+            return THROTTLED
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if code in TRANSIENT_CODES or status in TRANSIENT_STATUS:
+            return TRANSIENT
+        return None
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return TRANSIENT
+    return None
+
+
+class TokenBucket(object):
+    '''
+    TokenBucket rate limits the retries sent to a service. Throttling
+    responses halve the refill rate, successes slowly raise it again.
+    Without a clock it reads default_clock on each use, since buckets
+    outlive the invocations that may swap it.
+    '''
+    def __init__(self, rate=10.0, capacity=10.0, min_rate=0.5, clock=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.tokens = capacity
+        self.clock = clock
+        # The clock updated was read from, a different one starts the refill over
+        self.timed_by = None
+        self.updated = None
+        self.lock = threading.Lock()
+
+    def _clock(self):
+        return self.clock or default_clock
+
+    def _refill(self):
+        clock = self._clock()
+        now = clock.time()
+        if clock is not self.timed_by:
+            self.timed_by = clock
+            self.updated = now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, deadline=None):
+        '''
+        Takes a token, sleeping until one is available
+        '''
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and wait > deadline.remaining():
+                raise DeadlineExceeded("Out of time waiting to retry")
+            self._clock().sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 0.5)
+
+
+# Buckets are shared by every command calling the same service, for as long as the container lives
+buckets = {}
+buckets_lock = threading.Lock()
+
+def bucket(service):
+    with buckets_lock:
+        if service not in buckets:
+            buckets[service] = TokenBucket()
+        return buckets[service]
+
+
+class RetryPolicy(object):
+    '''
+    RetryPolicy calls a function, retrying throttling and transient errors
+    with jittered exponential backoff. Each retry takes a token from the
+    service's bucket, and no retry is started that would run past the deadline.
+    '''
+    def __init__(self, max_attempts=5, base_delay=0.2, max_delay=20.0, clock=None):
+        self.max_attempts = int(max_attempts)
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+        self.clock = clock or default_clock
+        self.attempts = 0
+
+    @classmethod
+    def from_command(cls, retry):
+        '''
+        Builds the policy from a CommandObject's Retry value, a dict of
+        MaxAttempts, BaseDelay and MaxDelay. False turns retries off.
+        '''
+        if isinstance(retry, dict):
+            return cls(
+                max_attempts=retry.get('MaxAttempts', 5),
+                base_delay=retry.get('BaseDelay', 0.2),
+                max_delay=retry.get('MaxDelay', 20.0)
+            )
+        if retry is not None and str(retry).lower() in ('false', '0', 'no'):
+            return cls(max_attempts=1)
+        return cls()
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def call(self, func, service, deadline=None):
+        limiter = bucket(service)
+        self.attempts = 0
+        while True:
+            # The first attempt always goes out, unless the commands were abandoned
+            if deadline is not None and (deadline.abandoned or (self.attempts and deadline.expired())):
+                raise DeadlineExceeded("Out of time before calling {}".format(service))
+            self.attempts += 1
+            try:
+                result = func()
+            except Exception as e:
+                kind = classify(e)
+                if kind is None or self.attempts >= self.max_attempts:
+                    raise
+                if kind == THROTTLED:
+                    limiter.throttled()
+                delay = self.backoff(self.attempts - 1)
+                if deadline is not None and delay >= deadline.remaining():
+                    raise DeadlineExceeded("Out of time retrying {}: {}".format(service, e))
+                logger.warning("Retrying %s after %s error, attempt %s, in %.2fs: %s", service, kind, self.attempts, delay, e)
+                self.clock.sleep(delay)
+                limiter.acquire(deadline)
+                continue
+            limiter.succeeded()
+            return result
@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from logger import logger
+from retry import DeadlineExceeded
+
+
+def run_graph(task, dependencies, max_workers=8, deadline=None):
+    '''
+    Runs task(i) for every key i in dependencies on a bounded thread pool.
+    dependencies maps each i to the set of keys that must finish before it
+    can start. Tasks with nothing left to wait on run concurrently.
+    The first task to raise cancels whatever has not started and the
+    exception is raised once the running tasks have finished.
+    If the deadline runs out first DeadlineExceeded is raised straight
+    away, without waiting on the tasks still running. The deadline is
+    abandoned so those tasks start no more API calls, a call already
+    made can still finish after the response is sent.
+    '''
+    waiting = {i: set(deps) for i, deps in dependencies.items()}
+    dependents = {}
+    for i, deps in waiting.items():
+        for dep in deps:
+            dependents.setdefault(dep, []).append(i)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    running = {}
+
+    def submit(ready):
+        for i in sorted(ready):
+            del waiting[i]
+            logger.debug("Scheduler: Starting: %s", i)
+            running[executor.submit(task, i)] = i
+
+    timed_out = False
+    try:
+        submit([i for i, deps in waiting.items() if not deps])
+        while running:
+            timeout = deadline.remaining() if deadline is not None and deadline.end is not None else None
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                timed_out = True
+                deadline.abandon()
+                logger.warning("Scheduler: Abandoning %s still running past the deadline, they make no further API calls",
+                               sorted(running.values()))
+                raise DeadlineExceeded("Out of time waiting on: {}".format(sorted(running.values())))
+            for future in done:
+                i = running.pop(future)
+                if future.exception() is not None:
+                    raise future.exception()
+                ready = []
+                for dependent in dependents.get(i, ()):
+                    waiting[dependent].discard(i)
+                    if not waiting[dependent]:
+                        ready.append(dependent)
+                submit(ready)
+    finally:
+        for pending in running:
+            pending.cancel()
+        executor.shutdown(wait=not timed_out)
+    if waiting:
+        raise ValueError("Unable to schedule, circular dependencies: {}".format(sorted(waiting)))
@@ -0,0 +1,324 @@
+import re
+from datetime import date, datetime
+from clients import client_pool
+from command import Command
+from helper import MODIFIERS, to_options
+
+SOURCE = re.compile(r'^(\w+)\[(\d+)\]$')
+
+# Any region builds a client to look up its methods, used when the session has none
+CLIENT_REGION = 'us-east-1'
+
+# Python types accepted for each botocore scalar shape
+SCALAR_TYPES = {
+    'string': (str,),
+    'integer': (int,),
+    'long': (int,),
+    'boolean': (bool,),
+    'float': (int, float),
+    'double': (int, float),
+    'blob': (str, bytes, bytearray),
+    'timestamp': (str, int, float, datetime, date),
+}
+
+OVERSIZE_OPTIONS = ('Truncate', 'Fail')
+
+
+class Models(object):
+    '''
+    Models loads botocore service models from the data bundled with
+    botocore, no credentials or API calls are needed. Models are read
+    through the client pool's loader, so a model loaded to validate a
+    command is not loaded again to build its client.
+    '''
+    def __init__(self):
+        self.session = None
+        self.operations = {}
+        self.waiters = {}
+        self.clients = {}
+
+    def _session(self):
+        if self.session is None:
+            self.session = client_pool.botocore_session()
+        return self.session
+
+    def service_name(self, service):
+        '''
+        Returns the name of the service's model, client names like
+        runtime.sagemaker are aliases boto3 accepts for another name
+        '''
+        from botocore.hooks import first_non_none_response
+        responses = self._session().get_component('event_emitter').emit('choose-service-name', service_name=service)
+        return first_non_none_response(responses, default=service)
+
+    def known(self, service):
+        from botocore.exceptions import UnknownServiceError
+        try:
+            self.operation(service, None)
+        except UnknownServiceError:
+            return False
+        return True
+
+    def operation(self, service, method):
+        '''
+        Returns the operation model for a client method, None if the service has no such method
+        '''
+        if service not in self.operations:
+            from botocore import xform_name
+            model = self._session().get_service_model(service)
+            self.operations[service] = dict(
+                (xform_name(name), model.operation_model(name)) for name in model.operation_names
+            )
+        return self.operations[service].get(method)
+
+    def client_method(self, service, method):
+        '''
+        Returns True when the service's client has method, for the methods
+        botocore and boto3 add that are not operations of the service
+        model, like generate_db_auth_token or upload_file
+        '''
+        return hasattr(self._client(service), method)
+
+    def can_paginate(self, service, method):
+        return self._client(service).can_paginate(method)
+
+    def _client(self, service):
+        if service not in self.clients:
+            session = client_pool.session()
+            if session.region_name is None:
+                session = client_pool.session(region=CLIENT_REGION)
+            self.clients[service] = client_pool.client(session, service, retries=False)
+        return self.clients[service]
+
+    def waiter(self, service, name):
+        if service not in self.waiters:
+            from botocore import xform_name
+            try:
+                names = self._session().get_waiter_model(service).waiter_names
+            except Exception:
+                names = []
+            self.waiters[service] = set(xform_name(waiter) for waiter in names)
+        return name in self.waiters[service]
+
+models = Models()
+
+
+def _format(path):
+    text = ''
+    for key in path:
+        text += '[{}]'.format(key) if isinstance(key, int) else ('.' + key if text else key)
+    return text
+
+
+def check_shape(shape, value, path, unresolved, errors):
+    '''
+    Checks value against a botocore shape, appending an error for each
+    unknown parameter, missing required member or wrong type. Paths in
+    unresolved hold lookups of earlier commands and are not checked.
+    '''
+    if path in unresolved:
+        return
+    kind = shape.type_name
+    if kind == 'structure':
+        if getattr(shape, 'is_document_type', False):
+            return
+        if not isinstance(value, dict):
+            errors.append("{} must be a dict, got {}".format(_format(path), type(value).__name__))
+            return
+        for name in shape.required_members:
+            if name not in value:
+                errors.append("{} is missing required parameter {}".format(_format(path), name))
+        for key, item in value.items():
+            if key not in shape.members:
+                errors.append("{} has unknown parameter {}, valid parameters are: {}".format(
+                    _format(path), key, ', '.join(sorted(shape.members))))
+            else:
+                check_shape(shape.members[key], item, path + (key,), unresolved, errors)
+    elif kind == 'list':
+        if not isinstance(value, list):
+            errors.append("{} must be a list, got {}".format(_format(path), type(value).__name__))
+            return
+        for index, item in enumerate(value):
+            check_shape(shape.member, item, path + (index,), unresolved, errors)
+    elif kind == 'map':
+        if not isinstance(value, dict):
+            errors.append("{} must be a dict, got {}".format(_format(path), type(value).__name__))
+            return
+        for key, item in value.items():
+            check_shape(shape.value, item, path + (key,), unresolved, errors)
+    elif kind in SCALAR_TYPES:
+        types = SCALAR_TYPES[kind]
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            errors.append("{} must be of type {}, got {}".format(_format(path), kind, type(value).__name__))
+
+
+def _check_command(cmd, unresolved, errors):
+    '''
+    Checks a command's client, method, waiter and arguments against the botocore models
+    '''
+    if ('Client',) in unresolved or ('Method',) in unresolved:
+        return
+    client, method = cmd['Client'], cmd['Method']
+    service = models.service_name(client)
+    if not models.known(service):
+        errors.append("unknown Client {}".format(client))
+        return
+    operation = models.operation(service, method)
+    if operation is None and not models.client_method(service, method):
+        errors.append("unknown Method {} for Client {}".format(method, client))
+        return
+    paginate = cmd.get('Paginate', None)
+    if ('Paginate',) not in unresolved and to_options(paginate) is not None:
+        if not models.can_paginate(service, method):
+            errors.append("{} can not be paginated".format(method))
+    if operation is None:
+        return
+    if operation.input_shape is not None:
+        check_shape(operation.input_shape, cmd['Arguments'], ('Arguments',), unresolved, errors)
+    elif cmd['Arguments']:
+        errors.append("{} takes no Arguments".format(method))
+    wait = cmd.get('Wait', {})
+    if 'Waiter' in wait and not models.waiter(service, wait['Waiter']):
+        errors.append("unknown Waiter {} for Client {}".format(wait['Waiter'], service))
+    if 'Method' in wait and models.operation(service, wait['Method']) is None:
+        errors.append("unknown Wait Method {} for Client {}".format(wait['Method'], service))
+
+
+def validate_plan(plan, action, place_holder, check_models=True):
+    '''
+    Validates the ActionObject for action in a compiled plan before any of
+    it runs. place_holder is the action of the event, command responses are
+    kept under it and its ActionObject gives the PhysicalResourceId and
+    ResponseData, an Update with Replace runs the Create Commands. Checks
+    their structure, that every !Action[i] lookup the run resolves names a
+    command that runs earlier, and with check_models each command's
+    client, method and arguments against the botocore service models.
+    Returns a list of errors, empty when the plan is valid.
+    '''
+    errors = []
+    action_obj = plan.data['ResourceProperties'].get(action, {})
+    if not isinstance(action_obj, dict):
+        return ["{} must be a dict".format(action)]
+    response_obj = plan.data['ResourceProperties'].get(place_holder, {})
+    if not isinstance(response_obj, dict):
+        return ["{} must be a dict".format(place_holder)]
+    commands = action_obj.get('Commands', [])
+    if not isinstance(commands, list):
+        return ["{}.Commands must be a list".format(action)]
+    if 'MaxConcurrency' in action_obj:
+        try:
+            assert int(action_obj['MaxConcurrency']) > 0
+        except (AssertionError, TypeError, ValueError):
+            errors.append("{}.MaxConcurrency must be a positive int".format(action))
+    if response_obj.get('OversizeResponse', OVERSIZE_OPTIONS[0]) not in OVERSIZE_OPTIONS:
+        errors.append("{}.OversizeResponse must be one of {}".format(place_holder, ', '.join(OVERSIZE_OPTIONS)))
+    if not isinstance(response_obj.get('ResponseData', {}), dict):
+        errors.append("{}.ResponseData must be a dict".format(place_holder))
+
+    # Lookups found in each command, and in the PhysicalResourceId and ResponseData sent back,
+    # lookups anywhere else in the ActionObjects are never resolved by this run
+    bases = set([
+        ('ResourceProperties', action, 'Commands'),
+        ('ResourceProperties', place_holder, 'PhysicalResourceId'),
+        ('ResourceProperties', place_holder, 'ResponseData'),
+    ])
+    unresolved = {}
+    for source, slots in plan.slots.items():
+        for slot in slots:
+            if slot.path[:3] not in bases:
+                continue
+            where = slot.path[2:]
+            count = where[1] if len(where) > 2 and where[0] == 'Commands' else None
+            match = SOURCE.match(source)
+            if match.group(1) != place_holder:
+                errors.append("{} looks up {}, only {}[i] lookups are resolved in {}".format(_format(where), source, place_holder, action))
+            elif int(match.group(2)) >= len(commands):
+                errors.append("{} looks up {}, there are only {} Commands".format(_format(where), source, len(commands)))
+            elif count is not None and int(match.group(2)) >= count:
+                errors.append("{} looks up {}, which does not run before it".format(_format(where), source))
+            # A modifier that is not registered, or not at the start of the lookup, is left in its path
+            for part in slot.lookup:
+                if not isinstance(part, str) or not part.startswith('!'):
+                    continue
+                if part[1:].split('(')[0] in MODIFIERS:
+                    errors.append("{} has modifier {} in its path, modifiers go right after {}.".format(_format(where), part, source))
+                else:
+                    errors.append("{} has unknown modifier {}, modifiers are: {}".format(_format(where), part, ', '.join(sorted(MODIFIERS))))
+            if count is not None:
+                unresolved.setdefault(count, set()).add(where[2:])
+
+    for count, cmd in enumerate(commands):
+        command_errors = []
+        try:
+            Command.validate(cmd, unresolved.get(count, set()))
+        except AssertionError as e:
+            command_errors.append(str(e))
+        else:
+            if check_models:
+                _check_command(cmd, unresolved.get(count, set()), command_errors)
+        errors.extend("Commands[{}]: {}".format(count, error) for error in command_errors)
+    return errors
+
+
+def _target_count(cmd):
+    '''
+    Returns how many regions and accounts a command fans out over, 0 when it
+    does not. The RoleArns are not parsed, they can be lookups or invalid.
+    '''
+    regions, roles = cmd.get('Region', None), cmd.get('RoleArn', None)
+    if not isinstance(regions, list) and not isinstance(roles, list):
+        return 0
+    return (len(regions) if isinstance(regions, list) else 1) * (len(roles) if isinstance(roles, list) else 1)
+
+
+def dry_run_report(plan, action, place_holder, dependencies, coalesced, errors):
+    '''
+    Describes what running the action would do without calling AWS: each
+    command with the Arguments it sends and what it waits on, and the fewest
+    and most API calls it can make. Lookups of earlier commands are left as
+    written in the Arguments. Retries are not counted, paginated commands
+    make a call per page.
+    '''
+    commands = plan.data['ResourceProperties'].get(action, {}).get('Commands', [])
+    report = {'Action': action, 'Errors': errors, 'Commands': []}
+    minimum = maximum = 0
+    calls = set()
+    for count, cmd in enumerate(commands):
+        if not isinstance(cmd, dict):
+            continue
+        cached = to_options(cmd.get('Cache')) is not None
+        entry = {
+            'Command': "{}[{}]".format(place_holder, count),
+            'Call': "{}.{}".format(cmd.get('Client'), cmd.get('Method')),
+            'Arguments': cmd.get('Arguments', {}),
+            'WaitsOn': sorted("{}[{}]".format(place_holder, dep) for dep in dependencies.get(count, ())),
+        }
+        if count in coalesced:
+            call = coalesced[count]
+            entry['CoalescedWith'] = sorted("{}[{}]".format(place_holder, member) for member in call.members if member != count)
+            if id(call) not in calls:
+                calls.add(id(call))
+                ids = set(i for members in call.members.values() for i in members)
+                batched = (len(ids) - 1) // call.batch.max_size + 1
+                minimum += batched
+                maximum += batched
+        else:
+            targets = _target_count(cmd)
+            calls_each = targets or 1
+            if targets:
+                entry['Targets'] = targets
+            # A cached command can be served without a call
+            minimum += 0 if cached else calls_each
+            maximum += calls_each
+        if to_options(cmd.get('Paginate')) is not None:
+            entry['Paginated'] = True
+        if isinstance(cmd.get('Wait'), dict):
+            checks = int(cmd['Wait'].get('MaxAttempts', 40))
+            entry['WaitChecks'] = checks
+            minimum += 1
+            maximum += checks
+        if cached:
+            entry['Cached'] = True
+        report['Commands'].append(entry)
+    report['EstimatedApiCalls'] = {'Min': minimum, 'Max': maximum}
+    return report